@@ -0,0 +1,21 @@
+### File hashes ###
+## Content hashes for caches and resume checks, shared by the pipeline assessment scripts and the recon-all pipelines ##
+
+import os
+import hashlib
+import functools
+
+
+# SHA-256 of a file's contents, read in 1 MB blocks; remembered while the file is unchanged
+def file_hash(path):
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def _file_hash(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,75 @@
+#####################################
+## Import-time guard for anatomy.py ##
+#####################################
+# Every mp2rage_recon-all.py / mprage_recon-all.py call imports anatomy, including --help and synthstrip-only
+# runs, so anatomy must not import nipype (SPM, MATLAB, CAT12, FreeSurfer interfaces) or configure the MCR at
+# import time. Run after touching the imports, with the pipeline folder to check (e.g. mp2rage_recon-all):
+# exits non-zero if nipype gets imported or the median import time of fresh interpreters exceeds --max-seconds.
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+PROBE = ("import sys, time, json; start = time.perf_counter(); import anatomy; "
+         "print(json.dumps({'seconds': time.perf_counter() - start, "
+         "'nipype_modules': sorted(m for m in sys.modules if m.split('.')[0] == 'nipype')}))")
+
+
+# Import anatomy in a fresh interpreter; -X importtime lists the cost of every imported module on stderr
+def measure(directory):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE], cwd=directory,
+                            capture_output=True, text=True, check=True)
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line and 'cumulative' not in line:
+            _, cumulative, module = line.split('|')
+            # nested imports are indented below their parent
+            imports.append((int(cumulative), module[1:].rstrip()))
+    measurement['direct_imports'] = sorted(direct_imports(imports, 'anatomy'), reverse=True)
+    return measurement
+
+
+# Imports made by module itself. -X importtime lists a module after everything it imported, so its children
+# are the entries one level deeper between the previous top-level entry and the module's own line
+# (the interpreter's startup imports, e.g. site and encodings, are top-level entries of their own)
+def direct_imports(imports, module):
+    children = []
+    for cumulative, name in imports:
+        if name == module:
+            return children
+        if not name.startswith(' '):
+            children = []
+        elif name.startswith('  ') and not name.startswith('   '):
+            children.append((cumulative, name.strip()))
+    return []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import-time benchmark and regression guard for anatomy.py")
+    parser.add_argument("pipeline", help="pipeline folder with the anatomy.py to check, e.g. mp2rage_recon-all")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters to time")
+    parser.add_argument("--max-seconds", type=float, default=1.5, help="limit for the median import time")
+    parser.add_argument("--top", type=int, default=10, help="slowest direct imports of anatomy to list")
+    args = parser.parse_args()
+
+    directory = os.path.abspath(args.pipeline)
+    measurements = [measure(directory) for _ in range(args.repeat)]
+    median = statistics.median(m['seconds'] for m in measurements)
+
+    print(f"import anatomy: median {median:.3f} s over {args.repeat} runs "
+          f"(min {min(m['seconds'] for m in measurements):.3f} s, limit {args.max_seconds} s)")
+    for cumulative, module in measurements[-1]['direct_imports'][:args.top]:
+        print(f"  {cumulative / 1e6:7.3f} s  {module}")
+
+    failed = False
+    if measurements[-1]['nipype_modules']:
+        print(f"FAIL: importing anatomy imports nipype: {', '.join(measurements[-1]['nipype_modules'][:5])} ...")
+        failed = True
+    if median > args.max_seconds:
+        print(f"FAIL: median import time {median:.3f} s exceeds {args.max_seconds} s")
+        failed = True
+    sys.exit(1 if failed else 0)
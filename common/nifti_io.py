@@ -0,0 +1,50 @@
+### NIfTI I/O ###
+## Compact loaders shared by the pipeline assessment scripts and the recon-all pipelines ##
+## get_fdata() upcasts everything to float64; label maps are kept in their on-disk integer dtype and images in float32 ##
+
+import gzip
+from contextlib import contextmanager
+
+import numpy as np
+import nibabel as nib
+
+
+def _load(niimg, mmap):
+    if isinstance(niimg, str):
+        # nibabel only memory-maps uncompressed, unscaled .nii files and reads the rest into memory
+        return nib.load(niimg, mmap='r' if mmap else False)
+    return niimg
+
+
+# Image for slab-by-slab reads in file order: uncompressed files are memory mapped, and a .nii.gz is read
+# through one open gzip stream, so consecutive slabs only decompress forward and the file is decompressed once
+# instead of once per slab (nibabel reopens a .gz path for every read without indexed_gzip)
+@contextmanager
+def open_for_slabs(path):
+    if not path.endswith('.gz'):
+        yield nib.load(path, mmap='r')
+        return
+    image_class = type(nib.load(path))
+    with gzip.open(path, 'rb') as stream:
+        yield image_class.from_stream(stream)
+
+
+# Label map (columns, layers, segmentations, parcellations) in its native integer dtype
+# slicer reads only part of the volume, e.g. (Ellipsis, slice(z0, z1)) for a slab of slices
+def load_labels(niimg, mmap=False, slicer=Ellipsis):
+    data = np.asanyarray(_load(niimg, mmap).dataobj[slicer])
+    if np.issubdtype(data.dtype, np.integer):
+        return data
+
+    # Labels saved as float (or with scaling) are converted to the smallest integer dtype that holds them
+    if not np.array_equal(data, np.round(data)):
+        raise ValueError(f"Label map {niimg} contains non-integer values")
+    return data.astype(np.min_scalar_type(int(np.max(data))) if np.min(data) >= 0 else np.int32)
+
+
+# Continuous image (responses, intensities, probability maps) as float32
+def load_image(niimg, dtype=np.float32, mmap=False):
+    data = np.asanyarray(_load(niimg, mmap).dataobj)
+    if data.dtype == dtype:
+        return data
+    return data.astype(dtype)
@@ -0,0 +1,170 @@
+##################################################
+## Managed subprocesses with resource accounting ##
+##################################################
+# External tools (recon-all, mri_synthstrip) run through start_stage/finish_stage: stdout and stderr go to
+# <log_dir>/<stage>.log, a non-zero exit code raises, and wall time, CPU time and peak RSS of every stage are
+# appended to a per-subject JSON timing report (used to size SLURM --time/--mem). The report keeps one entry per
+# run (start time, threads, stages), so resumed runs add to the timings of the earlier ones.
+
+import os
+import sys
+import json
+import time
+import signal
+import resource
+import subprocess
+from contextlib import contextmanager
+
+REPORT_FILENAME = 'timing_report.json'
+# Seconds a stopped stage gets to exit after SIGTERM before it is killed
+STOP_TIMEOUT = 30
+
+
+def new_report(derivatives_path, subject=None, session=None, threads=None):
+    report_file = os.path.join(derivatives_path, REPORT_FILENAME)
+
+    # Runs recorded earlier for this subject (single-run reports of older versions become one run)
+    previous_runs = []
+    if os.path.exists(report_file):
+        with open(report_file) as f:
+            previous = json.load(f)
+        previous_runs = previous.get('runs', [{'started': None, 'threads': None, 'stages': previous.get('stages', [])}])
+
+    return {'subject': subject, 'session': session, 'log_dir': os.path.join(derivatives_path, 'logs'),
+            'file': report_file, 'previous_runs': previous_runs,
+            'run': {'started': time.ctime(), 'threads': threads}, 'stages': []}
+
+
+def add_to_report(report, entry):
+    if report is None:
+        return
+    report['stages'].append(entry)
+
+    # Rewritten after every stage, so the report of a job killed by SLURM still covers the finished stages
+    runs = report['previous_runs'] + [dict(report['run'], stages=report['stages'])]
+    with open(report['file'], 'w') as f:
+        json.dump({'subject': report['subject'], 'session': report['session'], 'runs': runs}, f, indent=2)
+
+
+def start_stage(name, cmd, log_dir, env=None):
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, name + '.log')
+    log = open(log_file, 'w')
+    print(f"****** {name}: {' '.join(cmd)} (log: {log_file})")
+    # Own session and process group: recon-all is a tcsh wrapper, and stop_stage has to reach the binaries it runs
+    process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, start_new_session=True)
+    return {'name': name, 'cmd': cmd, 'process': process, 'log': log, 'log_file': log_file,
+            'started': time.time(), 'start': time.perf_counter()}
+
+
+def finish_stage(handle, report=None):
+    """
+    Wait for a started stage; wait4 reaps the child and returns its own resource usage,
+    so concurrent stages are accounted separately.
+    """
+    process = handle['process']
+    try:
+        _, status, usage = handle['waited'] if 'waited' in handle else os.wait4(process.pid, 0)
+    except BaseException:
+        # Interrupted while waiting (e.g. Ctrl-C, which no longer reaches the stage's own session)
+        stop_stage(handle)
+        raise
+    process.returncode = os.waitstatus_to_exitcode(status)
+    handle['log'].close()
+
+    entry = {'stage': handle['name'], 'command': handle['cmd'], 'exit_code': process.returncode,
+             'started': time.ctime(handle['started']), 'wall_s': round(time.perf_counter() - handle['start'], 2),
+             'user_cpu_s': round(usage.ru_utime, 2), 'sys_cpu_s': round(usage.ru_stime, 2),
+             'peak_rss_mb': round(usage.ru_maxrss / 1024, 1), 'log': handle['log_file']}
+    add_to_report(report, entry)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{handle['name']} failed with exit code {process.returncode}, see {handle['log_file']}")
+    print(f"****** {handle['name']}: {entry['wall_s']} s wall, {entry['user_cpu_s'] + entry['sys_cpu_s']:.1f} s CPU, "
+          f"{entry['peak_rss_mb']} MB peak RSS")
+    return entry
+
+
+def wait_any(handles):
+    """
+    Reap whichever of the started stages exits first and return its handle;
+    finish_stage then accounts it without waiting again.
+    """
+    pids = {handle['process'].pid: handle for handle in handles}
+    while True:
+        pid, status, usage = os.wait4(-1, 0)
+        if pid in pids:
+            pids[pid]['waited'] = (pid, status, usage)
+            return pids[pid]
+
+
+def signal_group(process, signum):
+    try:
+        os.killpg(process.pid, signum)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def stop_stage(handle, timeout=STOP_TIMEOUT):
+    """
+    Terminate a running stage whose results will not be used: SIGTERM to its whole process group,
+    SIGKILL to whatever of the group is still alive after timeout seconds.
+    """
+    process = handle['process']
+    if 'waited' not in handle and process.returncode is None:
+        signal_group(process, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while True:
+            # poll reaps the wrapper; the group is gone once its children have exited too
+            process.poll()
+            if not signal_group(process, 0):
+                break
+            if time.monotonic() > deadline:
+                print(f"****** {handle['name']}: still running {timeout} s after SIGTERM, killing it")
+                signal_group(process, signal.SIGKILL)
+                process.wait()
+                break
+            time.sleep(0.2)
+    handle['log'].close()
+
+
+def stop_stages(handles, timeout=STOP_TIMEOUT):
+    # SIGTERM to all stages first, so they shut down in parallel within one timeout
+    for handle in handles:
+        if 'waited' not in handle and handle['process'].returncode is None:
+            signal_group(handle['process'], signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    for handle in handles:
+        stop_stage(handle, max(0, deadline - time.monotonic()))
+
+
+def raise_on_sigterm():
+    # SIGTERM (scancel, preemption, the batch driver) unwinds like Ctrl-C, so running stages are stopped and
+    # the pipeline's cleanup runs; the stages' own sessions do not receive the signal
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+
+
+def run_stage(name, cmd, log_dir, report=None, env=None):
+    return finish_stage(start_stage(name, cmd, log_dir, env), report)
+
+
+@contextmanager
+def timed_stage(name, report=None):
+    """
+    Timing of an in-process stage (SPM/CAT12 through nipype, NumPy code). CPU time includes the
+    children reaped during the stage; peak RSS is the high-water mark of this process and its children so far.
+    """
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started, start = time.time(), time.perf_counter()
+    yield
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    entry = {'stage': name, 'command': None, 'exit_code': 0, 'started': time.ctime(started),
+             'wall_s': round(time.perf_counter() - start, 2),
+             'user_cpu_s': round(self_after.ru_utime - self_before.ru_utime + children_after.ru_utime - children_before.ru_utime, 2),
+             'sys_cpu_s': round(self_after.ru_stime - self_before.ru_stime + children_after.ru_stime - children_before.ru_stime, 2),
+             'peak_rss_mb': round(max(self_after.ru_maxrss, children_after.ru_maxrss) / 1024, 1), 'log': None}
+    add_to_report(report, entry)
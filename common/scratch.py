@@ -0,0 +1,131 @@
+#############################################
+## Node-local scratch for the recon-all run ##
+#############################################
+# recon-all writes many small intermediate files for 20+ hours. With a scratch directory the FreeSurfer
+# subject dir is worked on in <scratch>/<name>/ on the node's local disk and synced back to the derivatives
+# directory after every FreeSurfer stage and periodically in between, so a preempted job keeps the last checkpoint.
+# Stage markers always refer to the derivatives copy.
+
+import os
+import time
+import shutil
+import threading
+
+CHECKPOINT_INTERVAL = 30 * 60
+
+
+# $SLURM_TMPDIR or $TMPDIR when set
+def default_scratch_dir():
+    return os.environ.get('SLURM_TMPDIR') or os.environ.get('TMPDIR')
+
+
+def new_workspace(scratch_dir, fs_dir, sub, name):
+    """
+    Subject dir fs_dir/sub and its working copy. Without scratch_dir the working copy is the subject dir
+    itself and all syncs are no-ops.
+    """
+    work_root = os.path.join(scratch_dir, 'recon-all_' + name) if scratch_dir else None
+    work_fs_dir = work_root or fs_dir
+    return {'subject_dir': os.path.join(fs_dir, sub), 'work_fs_dir': work_fs_dir, 'work_root': work_root,
+            'work_subject_dir': os.path.join(work_fs_dir, sub), 'lock': threading.Lock(),
+            'stop': threading.Event(), 'thread': None, 'active': False}
+
+
+# Copy new and changed files (by size and mtime) from src to dst; files are replaced atomically.
+# With delete, files and directories no longer in src are removed from dst (e.g. scripts/IsRunning.*)
+def sync_tree(src, dst, delete=False):
+    copied = removed = 0
+    for root, dirs, files in os.walk(src):
+        target_root = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target_root, exist_ok=True)
+        if delete:
+            for name in set(os.listdir(target_root)) - set(dirs) - set(files):
+                target = os.path.join(target_root, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                else:
+                    os.remove(target)
+                removed += 1
+        for filename in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            source, target = os.path.join(root, filename), os.path.join(target_root, filename)
+            if os.path.islink(source):
+                link = os.readlink(source)
+                if not (os.path.islink(target) and os.readlink(target) == link):
+                    if os.path.lexists(target):
+                        os.remove(target)
+                    os.symlink(link, target)
+                continue
+            source_stat = os.stat(source)
+            if os.path.exists(target):
+                target_stat = os.stat(target)
+                if target_stat.st_size == source_stat.st_size and target_stat.st_mtime_ns == source_stat.st_mtime_ns:
+                    continue
+            shutil.copy2(source, target + '.partial')
+            os.replace(target + '.partial', target)
+            copied += 1
+    return copied, removed
+
+
+def is_staged(workspace):
+    return workspace['work_root'] is not None
+
+
+# Remove the subject dir and its working copy, for a recon-all run from scratch
+def reset(workspace):
+    with workspace['lock']:
+        for path in (workspace['subject_dir'], workspace['work_subject_dir']):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        workspace['active'] = True
+
+
+# Make the working copy an exact copy of the derivatives copy (a resumed job on a new node, or leftovers
+# of a killed job on this node)
+def stage_in(workspace):
+    if not is_staged(workspace) or not os.path.isdir(workspace['subject_dir']):
+        return
+    with workspace['lock']:
+        start = time.perf_counter()
+        copied, _ = sync_tree(workspace['subject_dir'], workspace['work_subject_dir'], delete=True)
+        workspace['active'] = True
+    print(f"****** staged {copied} files to {workspace['work_subject_dir']} in {time.perf_counter() - start:.1f} s")
+
+
+# Mirror the working copy to the derivatives copy; only once this run has reset or staged in the working
+# copy, so a stale copy on scratch never overwrites the derivatives
+def sync_back(workspace):
+    if not is_staged(workspace) or not workspace['active'] or not os.path.isdir(workspace['work_subject_dir']):
+        return
+    with workspace['lock']:
+        start = time.perf_counter()
+        copied, removed = sync_tree(workspace['work_subject_dir'], workspace['subject_dir'], delete=True)
+    print(f"****** synced {copied} files ({removed} removed) to {workspace['subject_dir']} in {time.perf_counter() - start:.1f} s")
+
+
+def start_checkpoints(workspace, interval=CHECKPOINT_INTERVAL):
+    if not is_staged(workspace) or not interval:
+        return
+
+    def checkpoint_loop():
+        while not workspace['stop'].wait(interval):
+            try:
+                sync_back(workspace)
+            except OSError as e:
+                # A failed checkpoint is retried at the next interval; the stage syncs still raise
+                print(f"****** checkpoint sync failed: {e}")
+
+    workspace['thread'] = threading.Thread(target=checkpoint_loop, name='scratch-checkpoints', daemon=True)
+    workspace['thread'].start()
+    print(f"****** checkpoint syncs to {workspace['subject_dir']} every {interval} s")
+
+
+# Stop the checkpoints, sync the final outputs back and free the node-local disk; also runs
+# when a stage failed, so its recon-all.log and recon-all.error end up in the derivatives
+def finish(workspace):
+    if not is_staged(workspace):
+        return
+    workspace['stop'].set()
+    if workspace['thread'] is not None:
+        workspace['thread'].join()
+    sync_back(workspace)
+    shutil.rmtree(workspace['work_root'], ignore_errors=True)
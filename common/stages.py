@@ -0,0 +1,73 @@
+############################################
+## Stage completion markers and resume ##
+############################################
+# Every pipeline stage writes <derivatives>/stage_markers/<stage>.json when it finishes, recording the
+# content hashes of its inputs and its parameters. A rerun skips a stage whose marker still matches and
+# whose outputs exist, so the pipeline resumes at the first stale stage. Shared by mp2rage_recon-all and mprage_recon-all.
+
+import os
+import json
+import time
+
+from hashes import file_hash
+
+MARKER_DIR = 'stage_markers'
+
+
+def stage_state(derivatives_path, stage_names, from_stage=None, until_stage=None):
+    marker_dir = os.path.join(derivatives_path, MARKER_DIR)
+    os.makedirs(marker_dir, exist_ok=True)
+    return {'marker_dir': marker_dir, 'names': list(stage_names),
+            'from': stage_names.index(from_stage) if from_stage else 0,
+            'until': stage_names.index(until_stage) if until_stage else len(stage_names) - 1,
+            'force': from_stage is not None, 'pending': {}}
+
+
+def marker_file(state, stage):
+    return os.path.join(state['marker_dir'], stage + '.json')
+
+
+def should_run(state, stage, inputs, params, outputs):
+    """
+    Decide whether a stage runs. Stages outside --from-stage/--until-stage are skipped, stages from
+    --from-stage on are always rerun, and the others run only if their marker is missing or stale.
+    """
+    index = state['names'].index(stage)
+    if index < state['from'] or index > state['until']:
+        print(f"****** stage {stage}: outside the selected stage range, skipped")
+        return False
+
+    missing = [path for path in inputs if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Stage {stage} needs {', '.join(missing)}; run the earlier stages first")
+    signature = {'inputs': {path: file_hash(path) for path in inputs}, 'params': params}
+    state['pending'][stage] = (signature, outputs)
+
+    if not state['force']:
+        marker = read_marker(state, stage)
+        if marker is not None and marker['signature'] == signature and all(os.path.exists(path) for path in outputs):
+            print(f"****** stage {stage}: up to date, skipped")
+            return False
+
+    # Invalidate the marker first, so a stage that crashes half way is never taken as complete
+    if os.path.exists(marker_file(state, stage)):
+        os.remove(marker_file(state, stage))
+    print(f"****** stage {stage}: running")
+    return True
+
+
+def read_marker(state, stage):
+    if not os.path.exists(marker_file(state, stage)):
+        return None
+    with open(marker_file(state, stage)) as f:
+        return json.load(f)
+
+
+def mark_done(state, stage):
+    signature, outputs = state['pending'].pop(stage)
+    missing = [path for path in outputs if not os.path.exists(path)]
+    if missing:
+        raise RuntimeError(f"Stage {stage} did not produce {', '.join(missing)}")
+
+    with open(marker_file(state, stage), 'w') as f:
+        json.dump({'stage': stage, 'signature': signature, 'outputs': outputs, 'completed': time.ctime()}, f, indent=2)
@@ -2,30 +2,61 @@
 ## Preprocessing Pipeline for MP2RAGE ##
 ########################################
 
-from nipype.interfaces import spm
-from nipype.interfaces import matlab
-from nipype.interfaces import cat12
-from nipype.interfaces.freesurfer import ApplyVolTransform, ApplyMask
-import nipype.pipeline.engine as pe
 import nibabel as nib
 import numpy as np
+from scipy import ndimage
 import os
 import sys
+import math
 import gzip
 import shutil
 import subprocess
 from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 
+# NIfTI loaders, stage markers, the stage runner and scratch handling are shared with the other pipeline
+# through the common folder at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import nifti_io
+import mprageise
+import stages
+import runner
+import scratch
+
+
+# Pipeline stages in execution order, each with a completion marker (see stages.py)
+STAGES = ['mprageize', 'skullstrip', 'maskfusion', 'autorecon1', 'brainmask', 'autorecon23']
 
 matlab_cmd = '/opt/spm12/run_spm12.sh /opt/mcr/v93 script'
 spm_path = '/opt/spm12/spm12_mcr/home/gaser/gaser/spm/spm12'
-spm.SPMCommand.set_mlab_paths(matlab_cmd=matlab_cmd, use_mcr=True)
+mcr_configured = False
+
+# nipype's SPM interfaces are imported and pointed at the MCR on first use, so runs without SPM/CAT12
+# stages (synthstrip, --help) do not pay for it; see import_benchmark.py
+def spm_interfaces():
+    global mcr_configured
+    from nipype.interfaces import spm
+    if not mcr_configured:
+        spm.SPMCommand.set_mlab_paths(matlab_cmd=matlab_cmd, use_mcr=True)
+        mcr_configured = True
+    return spm
 
 def set_spm_path(new_spm_path):
+    from nipype.interfaces import matlab
     global spm_path
     spm_path = new_spm_path
     matlab.MatlabCommand.set_default_paths(spm_path)
 
+# Default thread budget: the CPUs SLURM gave this task, otherwise the tools' own defaults
+def default_threads():
+    threads = os.environ.get('SLURM_CPUS_PER_TASK')
+    return int(threads) if threads else None
+
+# Limit the MATLAB runtime of an SPM/CAT12 interface to a number of computational threads
+def limit_mcr_threads(interface, threads):
+    if threads:
+        interface.mlab.inputs.prescript = list(interface.mlab.inputs.prescript) + [f"maxNumCompThreads({threads});"]
+
 def check_spm_path():
     print(spm_path)
     
@@ -37,7 +68,7 @@ def load_niimg(niimg):
 
 def normalize(niimg_in,out_file=None):
     niimg_in = load_niimg(niimg_in)
-    data = niimg_in.get_fdata()
+    data = nifti_io.load_image(niimg_in)
     data_norm = (data-np.min(data))/(np.max(data)-np.min(data))
     niimg_out = nib.Nifti1Image(data_norm,niimg_in.affine,niimg_in.header)
     if out_file:
@@ -47,8 +78,8 @@ def normalize(niimg_in,out_file=None):
 def multiply(niimg_in1, niimg_in2, out_file=None):
     niimg_in1 = load_niimg(niimg_in1)
     niimg_in2 = load_niimg(niimg_in2)
-    data1 = niimg_in1.get_fdata()
-    data2 = niimg_in2.get_fdata()
+    data1 = nifti_io.load_image(niimg_in1)
+    data2 = nifti_io.load_image(niimg_in2)
     data_mult = data1 * data2
     niimg_out = nib.Nifti1Image(data_mult,niimg_in1.affine,niimg_in1.header)
     if out_file:
@@ -56,93 +87,134 @@ def multiply(niimg_in1, niimg_in2, out_file=None):
     return niimg_out
 
 
-def mprageize(inv2_file, uni_file, out_file=None):
+# Bias correction provider running SPM NewSegment on INV2; returns the path of the bias corrected image
+def spm_bias_correction(inv2_file, cwd, threads=None):
+    seg = spm_interfaces().NewSegment()
+    seg.inputs.channel_files = inv2_file
+    seg.inputs.channel_info = (0.001, 30, (False, True))
+    tissue1 = ((os.path.join(spm_path,'tpm','TPM.nii'), 1), 2, (False,False), (False, False))
+    tissue2 = ((os.path.join(spm_path,'tpm','TPM.nii'), 2), 2, (False,False), (False, False))
+    tissue3 = ((os.path.join(spm_path,'tpm','TPM.nii'), 3), 2, (False,False), (False, False))
+    tissue4 = ((os.path.join(spm_path,'tpm','TPM.nii'), 4), 3, (False,False), (False, False))
+    tissue5 = ((os.path.join(spm_path,'tpm','TPM.nii'), 5), 4, (False,False), (False, False))
+    tissue6 = ((os.path.join(spm_path,'tpm','TPM.nii'), 6), 2, (False,False), (False, False))
+    seg.inputs.tissues = [tissue1, tissue2, tissue3, tissue4, tissue5, tissue6]    
+    seg.inputs.affine_regularization = 'mni'
+    seg.inputs.sampling_distance = 3
+    seg.inputs.warping_regularization = [0, 0.001, 0.5, 0.05, 0.2]
+    seg.inputs.write_deformation_fields = [False, False]
+    limit_mcr_threads(seg, threads)
+    seg_results = seg.run(cwd = cwd)
+    return seg_results.outputs.bias_corrected_images
+
+
+# SPM NewSegment as a bias provider (see mprageise.py). SPM reads INV2 from its file, so there is no INV2 range
+# here, and the corrected image is returned with its own header for the intermediates
+def spm_bias_provider(inv2, inv2_file=None, out_dir=None, threads=None, **options):
+    return nib.load(spm_bias_correction(inv2_file, out_dir, threads)), None
+
+
+# INV2 bias providers by --bias-correction name, SPM (the default) first
+BIAS_PROVIDERS = {'spm': spm_bias_provider, **mprageise.BIAS_PROVIDERS}
+
+
+# .nii.gz copy of an input image: gzip of the file as it is, or a plain copy when it is already compressed
+def gzip_copy(input_file, out_file):
+    if input_file.endswith('.gz'):
+        shutil.copyfile(input_file, out_file)
+        return
+    with open(input_file, 'rb') as src, gzip.open(out_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+
+def mprageize(inv2_file, uni_file, out_file=None, save_intermediates=False, bias_correction='spm', bias_field_file=None,
+              threads=None):
     """ 
     Based on Sri Kashyap (https://github.com/srikash/presurfer/blob/main/func/presurf_MPRAGEise.m)
+    The arithmetic runs in mprageise.mprageise; bias_correction names the INV2 bias field provider in BIAS_PROVIDERS:
+    'spm' (NewSegment), 'file' (precomputed bias_field_file) or 'polynomial' (fast NumPy estimate).
+    Gzipped intermediates are only written with save_intermediates.
     """
     
-    # Create a directory for intermediate outputs
+    if bias_correction not in BIAS_PROVIDERS:
+        raise ValueError(f"Invalid bias correction. Choose one of {', '.join(BIAS_PROVIDERS)}.")
+
+    # Create a directory for intermediate outputs and image statistics
     intermediate_dir = os.path.join(os.path.dirname(out_file), 'intermediate_outputs_mpragization')
     os.makedirs(intermediate_dir, exist_ok=True)
     
-    # mprageize using temporary directory
-    with TemporaryDirectory() as tmpdirname:
+    # mprageize using temporary directory; intermediates are compressed and written by a background thread
+    with TemporaryDirectory() as tmpdirname, ThreadPoolExecutor(max_workers=1) as writer:
+        pending = []
+        def save_intermediate(img, filename):
+            pending.append(writer.submit(nib.save, img, os.path.join(intermediate_dir, filename)))
+        def save_input_copy(input_file, filename):
+            pending.append(writer.submit(gzip_copy, input_file, os.path.join(intermediate_dir, filename)))
+
+        # SPM writes its outputs next to the channel file, so INV2 is copied to the temporary directory
         copied_inv2 = os.path.join(tmpdirname, 'copied_inv2.nii')
-        copied_uni = os.path.join(tmpdirname, 'copied_uni.nii')
         shutil.copyfile(inv2_file, copied_inv2)
-        shutil.copyfile(uni_file, copied_uni)
-
-        # Save input images
-        nib.save(nib.load(copied_inv2), os.path.join(intermediate_dir, '01_input_inv2.nii.gz'))
-        nib.save(nib.load(copied_uni), os.path.join(intermediate_dir, '01_input_uni.nii.gz'))
-
-        # bias correct INV2
-        seg = spm.NewSegment()
-        seg.inputs.channel_files = copied_inv2
-        seg.inputs.channel_info = (0.001, 30, (False, True))
-        tissue1 = ((os.path.join(spm_path,'tpm','TPM.nii'), 1), 2, (False,False), (False, False))
-        tissue2 = ((os.path.join(spm_path,'tpm','TPM.nii'), 2), 2, (False,False), (False, False))
-        tissue3 = ((os.path.join(spm_path,'tpm','TPM.nii'), 3), 2, (False,False), (False, False))
-        tissue4 = ((os.path.join(spm_path,'tpm','TPM.nii'), 4), 3, (False,False), (False, False))
-        tissue5 = ((os.path.join(spm_path,'tpm','TPM.nii'), 5), 4, (False,False), (False, False))
-        tissue6 = ((os.path.join(spm_path,'tpm','TPM.nii'), 6), 2, (False,False), (False, False))
-        seg.inputs.tissues = [tissue1, tissue2, tissue3, tissue4, tissue5, tissue6]    
-        seg.inputs.affine_regularization = 'mni'
-        seg.inputs.sampling_distance = 3
-        seg.inputs.warping_regularization = [0, 0.001, 0.5, 0.05, 0.2]
-        seg.inputs.write_deformation_fields = [False, False]
-        seg_results = seg.run(cwd = os.path.dirname(os.path.abspath(out_file)))
-        
-        # Save bias corrected image
-        bias_corrected_img = nib.load(seg_results.outputs.bias_corrected_images)
-        nib.save(bias_corrected_img, os.path.join(intermediate_dir, '02_bias_corrected_inv2.nii.gz'))
-        
-        # normalize bias corrected INV2
-        norm_inv2_niimg = normalize(seg_results.outputs.bias_corrected_images)
-        
-        # Save normalized image
-        nib.save(norm_inv2_niimg, os.path.join(intermediate_dir, '03_normalized_inv2.nii.gz'))
-        
-        # Load UNI image
-        uni_img = nib.load(copied_uni)
-        uni_data = uni_img.get_fdata()
-        
-        # Shift and rescale UNI image
-        uni_min = np.min(uni_data)
-        uni_max = np.max(uni_data)
-        uni_shifted = uni_data - uni_min
-        uni_rescaled = uni_shifted / (uni_max - uni_min)
-        
-        # Save shifted and rescaled UNI image
-        uni_rescaled_nii = nib.Nifti1Image(uni_rescaled, uni_img.affine, uni_img.header)
-        nib.save(uni_rescaled_nii, os.path.join(intermediate_dir, '04_uni_shifted_rescaled.nii.gz'))
-        
-        # multiply normalized bias corrected INV2 with shifted and rescaled UNI
-        mprageized_data = norm_inv2_niimg.get_fdata() * uni_rescaled
-        
+
+        # Input images are read slab by slab from their data proxies, each of them once; the 01 intermediates are
+        # gzipped copies of the input files
+        inv2_img = nib.load(copied_inv2)
+        uni_img = nib.load(uni_file)
+        if save_intermediates:
+            save_input_copy(inv2_file, '01_input_inv2.nii.gz')
+            save_input_copy(uni_file, '01_input_uni.nii.gz')
+
+        # bias correct INV2; the NumPy providers return the original INV2 range from their read of INV2
+        bias_corrected, inv2_range = BIAS_PROVIDERS[bias_correction](
+            inv2_img.dataobj, inv2_file=copied_inv2, bias_field_file=bias_field_file,
+            out_dir=os.path.dirname(os.path.abspath(out_file)), threads=threads)
+        if isinstance(bias_corrected, nib.spatialimages.SpatialImage):
+            bias_corrected_img, bias_corrected_data = bias_corrected, bias_corrected.dataobj
+        else:
+            bias_corrected_img = nib.Nifti1Image(bias_corrected, inv2_img.affine, inv2_img.header)
+            bias_corrected_data = bias_corrected
+
+        # normalize bias corrected INV2, rescale UNI and multiply them; SPM read INV2 itself, so its range is
+        # collected in the same pass that reads the bias corrected INV2 and UNI
+        mprageized_data, stats, intermediates = mprageise.mprageise(
+            bias_corrected_data, uni_img.dataobj, inv2=inv2_img.dataobj if inv2_range is None else None,
+            keep_intermediates=save_intermediates)
+        if inv2_range is not None:
+            stats['inv2'] = inv2_range
+
         # Rescale the final result to match the desired output range (e.g., 0 to 4095)
         # mprageized_rescaled = (mprageized_data - np.min(mprageized_data)) / (np.max(mprageized_data) - np.min(mprageized_data)) * 4095
         
         # Create and save the final MPRAGEized image
         mprageized_nii = nib.Nifti1Image(mprageized_data, uni_img.affine, uni_img.header)
         nib.save(mprageized_nii, out_file)
-        
-        # Also save it in the intermediate directory
-        nib.save(mprageized_nii, os.path.join(intermediate_dir, '05_final_mprageized.nii.gz'))
 
-        # Save image statistics
+        # Intermediates come from the float32 arrays of the MPRAGEise passes, nothing is read again
+        if save_intermediates:
+            save_intermediate(nib.Nifti1Image(intermediates['bias_corrected_inv2'], bias_corrected_img.affine,
+                                              bias_corrected_img.header), '02_bias_corrected_inv2.nii.gz')
+            save_intermediate(nib.Nifti1Image(intermediates['normalized_inv2'], bias_corrected_img.affine,
+                                              bias_corrected_img.header), '03_normalized_inv2.nii.gz')
+            save_intermediate(nib.Nifti1Image(intermediates['rescaled_uni'], uni_img.affine, uni_img.header),
+                              '04_uni_shifted_rescaled.nii.gz')
+            save_intermediate(mprageized_nii, '05_final_mprageized.nii.gz')
+
+        # Save image statistics, all measured on the images themselves
         with open(os.path.join(intermediate_dir, 'image_stats.txt'), 'w') as f:
-            f.write(f"Original INV2 range: {np.min(nib.load(copied_inv2).get_fdata())} to {np.max(nib.load(copied_inv2).get_fdata())}\n")
-            f.write(f"Bias corrected INV2 range: {np.min(bias_corrected_img.get_fdata())} to {np.max(bias_corrected_img.get_fdata())}\n")
-            f.write(f"Normalized INV2 range: {np.min(norm_inv2_niimg.get_fdata())} to {np.max(norm_inv2_niimg.get_fdata())}\n")
-            f.write(f"Original UNI range: {uni_min} to {uni_max}\n")
-            f.write(f"Shifted and rescaled UNI range: {np.min(uni_rescaled)} to {np.max(uni_rescaled)}\n")
-            f.write(f"Final MPRAGEized range: {np.min(mprageized_data)} to {np.max(mprageized_data)}\n")
+            f.write(f"Original INV2 range: {stats['inv2'][0]} to {stats['inv2'][1]}\n")
+            f.write(f"Bias corrected INV2 range: {stats['bias_corrected_inv2'][0]} to {stats['bias_corrected_inv2'][1]}\n")
+            f.write(f"Normalized INV2 range: {stats['normalized_inv2'][0]} to {stats['normalized_inv2'][1]}\n")
+            f.write(f"Original UNI range: {stats['uni'][0]} to {stats['uni'][1]}\n")
+            f.write(f"Shifted and rescaled UNI range: {stats['rescaled_uni'][0]} to {stats['rescaled_uni'][1]}\n")
+            f.write(f"Final MPRAGEized range: {stats['mprageised'][0]} to {stats['mprageised'][1]}\n")
+
+        # Finish the background writes before the temporary directory is removed
+        for future in pending:
+            future.result()
 
     return mprageized_nii
 
 
-def cat12_seg(in_file,cat12_output_dir):
+def cat12_seg(in_file, cat12_output_dir, threads=None):
 
     # CAT12 segmentation using temporary memory
     with TemporaryDirectory() as tmpdirname:
@@ -156,6 +228,8 @@ def cat12_seg(in_file,cat12_output_dir):
         median_res = np.median(img.header.get_zooms()[:3])
         
         # Create CAT12 object with specific parameters
+        spm_interfaces()
+        from nipype.interfaces import cat12
         cat12_segment = cat12.CAT12Segment(in_files = copied_input)
         cat12_segment.inputs.internal_resampling_process = (median_res, 0.1)
         cat12_segment.inputs.surface_and_thickness_estimation = 0
@@ -181,6 +255,7 @@ def cat12_seg(in_file,cat12_output_dir):
         cat12_segment.inputs.output_labelnative = True
         # cat12_segment.inputs.output_surface = False
         # cat12_segment.inputs.no_surf = True
+        limit_mcr_threads(cat12_segment, threads)
         cat12_segment.run(cwd = tmpdirname) 
 
         # Get current filename of the bias Corrected file
@@ -202,14 +277,90 @@ def cat12_seg(in_file,cat12_output_dir):
     
 
 
-def mri_synthstrip(in_file, brain_file=None):
+# Brain mask from the CAT12 GM (p1) and WM (p2) maps as uint8, applied to the T1w in place
+def fuse_brain_mask(gm_file, wm_file, image_file, brainmask_file, brain_file, fill_holes=False, largest_component=False):
+    gm_nii = nib.load(gm_file)
+    wm_nii = nib.load(wm_file)
+    image_nii = nib.load(image_file)
+
+    # Mask built slab by slab, so the GM and WM maps are never held in memory as full volumes
+    brainmask_data = np.zeros(image_nii.shape[:3], dtype=np.uint8)
+    for start in range(0, brainmask_data.shape[-1], 32):
+        slab = (Ellipsis, slice(start, start + 32))
+        brainmask_data[slab] = (np.asanyarray(gm_nii.dataobj[slab]) > 0) | (np.asanyarray(wm_nii.dataobj[slab]) > 0)
+
+    # Optional cleanup: fill enclosed holes, keep only the largest connected component
+    if fill_holes:
+        brainmask_data = ndimage.binary_fill_holes(brainmask_data).astype(np.uint8)
+    if largest_component:
+        components, n_components = ndimage.label(brainmask_data)
+        if n_components > 1:
+            sizes = np.bincount(components.ravel())
+            sizes[0] = 0
+            brainmask_data = (components == sizes.argmax()).astype(np.uint8)
+
+    mask_header = image_nii.header.copy()
+    mask_header.set_data_dtype(np.uint8)
+    nib.save(nib.Nifti1Image(brainmask_data, image_nii.affine, mask_header), brainmask_file)
+    print("****** brain mask saved")
+
+    # Brain extraction by masking the float32 T1w in place
+    brain_data = np.require(nifti_io.load_image(image_nii), requirements='W')
+    np.multiply(brain_data, brainmask_data, out=brain_data)
+    nib.save(nib.Nifti1Image(brain_data, image_nii.affine, image_nii.header), brain_file)
+    print("****** brain extraction saved")
+
+    return brainmask_file, brain_file
+
+
+# Nearest-neighbour resampling of a mask into the voxel grid of target_file through the header (scanner RAS)
+# geometry of both images, as mri_vol2vol --regheader --interp nearest; voxels mapping outside the mask are 0
+def resample_to_target(mask_file, target_file):
+    mask_img = nib.load(mask_file)
+    target_img = nib.load(target_file)
+    mask_data = nifti_io.load_labels(mask_img)
+
+    # target voxel -> mask voxel, computed one target slice at a time
+    vox2vox = np.linalg.inv(mask_img.affine) @ target_img.affine
+    shape = target_img.shape[:3]
+    i = np.arange(shape[0])[:, None]
+    j = np.arange(shape[1])[None, :]
+    resampled = np.zeros(shape, dtype=mask_data.dtype)
+    for k in range(shape[2]):
+        index = [np.floor(vox2vox[axis, 0] * i + vox2vox[axis, 1] * j + vox2vox[axis, 2] * k + vox2vox[axis, 3] + 0.5).astype(np.intp)
+                 for axis in range(3)]
+        inside = np.ones(shape[:2], dtype=bool)
+        for axis in range(3):
+            inside &= (index[axis] >= 0) & (index[axis] < mask_data.shape[axis])
+        resampled[..., k][inside] = mask_data[index[0][inside], index[1][inside], index[2][inside]]
+    return resampled
+
+# brainmask.mgz and brainmask.auto.mgz: T1.mgz with all voxels outside the resampled brain mask set to 0 (as mri_mask)
+def apply_brain_mask(brainmask_file, mri_dir):
+    t1_img = nib.load(os.path.join(mri_dir, 'T1.mgz'))
+    mask_data = resample_to_target(brainmask_file, os.path.join(mri_dir, 'orig.mgz'))
+    if mask_data.shape != t1_img.shape[:3]:
+        raise ValueError(f"orig.mgz and T1.mgz shapes differ: {mask_data.shape} vs {t1_img.shape[:3]}")
+
+    brainmask_data = np.array(t1_img.dataobj)
+    brainmask_data[mask_data == 0] = 0
+    brainmask_img = nib.MGHImage(brainmask_data, t1_img.affine, t1_img.header)
+    for filename in ('brainmask.mgz', 'brainmask.auto.mgz'):
+        nib.save(brainmask_img, os.path.join(mri_dir, filename))
+    print("****** brain mask applied to T1.mgz")
+    return os.path.join(mri_dir, 'brainmask.mgz')
+
+
+
+def mri_synthstrip(in_file, brain_file=None, log_dir=None, report=None, threads=None):
     # Generate output filename
     brain_file = os.path.join(os.path.dirname(in_file), os.path.basename(in_file).replace('_T1w.nii', '_synthstrip_brain.nii'))
     mask_file = os.path.join(os.path.dirname(in_file), os.path.basename(in_file).replace('_T1w.nii', '_synthstrip_brain_mask.nii'))
 
     # Run mri_synthstrip to extract brain and create mask
     cmd = ['mri_synthstrip', '-i', in_file, '-o', brain_file, '-m', mask_file, '--no-csf']
-    subprocess.run(cmd, check=True)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads)) if threads else None
+    runner.run_stage('mri_synthstrip', cmd, log_dir or os.path.join(os.path.dirname(in_file), 'logs'), report, env)
 
     # Check if the output brain file and mask file were created
     if not os.path.exists(brain_file):
@@ -221,7 +372,10 @@ def mri_synthstrip(in_file, brain_file=None):
               
 
 
-def mp2rage_recon_all(inv2_file, uni_file, output_fs_dir=None, gdc_coeff_file=None, skull_strip_method=None):
+def mp2rage_recon_all(inv2_file, uni_file, output_fs_dir=None, gdc_coeff_file=None, skull_strip_method=None,
+                      save_intermediates=False, bias_correction='spm', bias_field_file=None,
+                      from_stage=None, until_stage=None, threads=None, fill_holes=False, largest_component=False,
+                      mask_resampling='nibabel', scratch_dir=None, checkpoint_interval=scratch.CHECKPOINT_INTERVAL):
     
     ##################
     ## MPRagization ##
@@ -248,9 +402,27 @@ def mp2rage_recon_all(inv2_file, uni_file, output_fs_dir=None, gdc_coeff_file=No
     # Create filename and path for mpragize output
     uni_mprageized_file = os.path.join(derivatives_path, subject_foldername + '_' + session_name + '_T1w.nii')
 
+    # Threads for recon-all, synthstrip and the MATLAB runtime; SLURM_CPUS_PER_TASK unless given
+    threads = threads or default_threads()
+    print(f"****** threads: {threads if threads else 'tool defaults'}")
+
+    # Optional cleanup of the fused CAT12 mask
+    mask_cleanup = {'fill_holes': fill_holes, 'largest_component': largest_component}
+
+    # Completion markers of the stages under derivatives_path/stage_markers
+    state = stages.stage_state(derivatives_path, STAGES, from_stage, until_stage)
+
+    # Per-stage logs under derivatives_path/logs and timing report derivatives_path/timing_report.json
+    report = runner.new_report(derivatives_path, subject_foldername, session_name, threads)
+
     # Perform bias correction by calling the mpragize function
-    mprageize(inv2_file, uni_file, uni_mprageized_file)
-    print("****** mprageize  complete")
+    mprageize_inputs = [inv2_file, uni_file] + ([bias_field_file] if bias_field_file else [])
+    if stages.should_run(state, 'mprageize', mprageize_inputs, {'bias_correction': bias_correction}, [uni_mprageized_file]):
+        with runner.timed_stage('mprageize', report):
+            mprageize(inv2_file, uni_file, uni_mprageized_file, save_intermediates=save_intermediates,
+                      bias_correction=bias_correction, bias_field_file=bias_field_file, threads=threads)
+        stages.mark_done(state, 'mprageize')
+        print("****** mprageize  complete")
 
     # run gdc
     #if gdc_coeff_file is not None:
@@ -260,50 +432,17 @@ def mp2rage_recon_all(inv2_file, uni_file, output_fs_dir=None, gdc_coeff_file=No
     #    brainmask_file = brainmask_file.replace('brainmask','brainmask_gdc')
 
 
-    ####################################################
-    ## Brain extraction either by CAT12 or Synthstrip ##
-    ####################################################    
-    # Synthstrip performs skullstripping #
-    # CAT12 performs GM and WM segmentation and then combines them #
+    # Outputs of the brain extraction
     if skull_strip_method == 'synthstrip':
-        # Call mri_synthstrip function on bias corrected image
-        brain_file, brainmask_filepath = mri_synthstrip(uni_mprageized_file, derivatives_path)
-        print("skull removing and brain mask creation via synthstrip is complete!!!!!")
-    
-    elif skull_strip_method == 'cat12': 
-        cat12_output_dir=os.path.join(derivatives_path,'mri')
-        gm_file, wm_file = cat12_seg(uni_mprageized_file, cat12_output_dir)
-        print("****** CAT12 complete")
-
-        # Load the GM and WM files (saved by CAT12) and mprageized file
-        gm_nii = nib.load(gm_file)
-        wm_nii = nib.load(wm_file)
-        uni_mprageized_nii = nib.load(uni_mprageized_file)
-        print("****** segmentations and uni_mprageized_loaded")
-
-        # Get data from these nifti files
-        gm_data = gm_nii.get_fdata()
-        wm_data = wm_nii.get_fdata()
-        uni_mprageized_data = uni_mprageized_nii.get_fdata()    
-        print("****** data from segmentations and uni_mprageized_data extracted")
-
-        # Creating and saving brain mask
+        brain_file = uni_mprageized_file.replace('_T1w.nii', '_synthstrip_brain.nii')
+        brainmask_filepath = uni_mprageized_file.replace('_T1w.nii', '_synthstrip_brain_mask.nii')
+        skullstrip_outputs = [brain_file, brainmask_filepath]
+    elif skull_strip_method == 'cat12':
         brainmask_filepath = os.path.join(derivatives_path, f"{subject_foldername}_{session_name}_T1w_brainmask.nii")
-        brainmask_data = np.array(((wm_data > 0) | (gm_data > 0)),dtype=int)
-        brainmask_nii = nib.Nifti1Image(brainmask_data,
-                                        uni_mprageized_nii.affine,
-                                        uni_mprageized_nii.header)
-        nib.save(brainmask_nii, brainmask_filepath)
-        print("****** brain mask saved")
-
-        # Creating and saving brain extraction
         uni_mprageized_brain_filepath = os.path.join(derivatives_path, f"{subject_foldername}_{session_name}_T1w_brain.nii")
-        uni_mprageized_brain_data = brainmask_data * uni_mprageized_data
-        uni_mprageized_brain_nii = nib.Nifti1Image(uni_mprageized_brain_data,
-                                                uni_mprageized_nii.affine,
-                                                uni_mprageized_nii.header)
-        nib.save(uni_mprageized_brain_nii, uni_mprageized_brain_filepath)
-        print("****** brain extraction saved")
+        gm_file = os.path.join(derivatives_path, 'mri', 'p1' + os.path.basename(uni_mprageized_file))
+        wm_file = os.path.join(derivatives_path, 'mri', 'p2' + os.path.basename(uni_mprageized_file))
+        skullstrip_outputs = [gm_file, wm_file]
     else:
         raise ValueError("Invalid skull stripping method. Choose either 'synthstrip' or 'cat12'.")
 
@@ -315,53 +454,152 @@ def mp2rage_recon_all(inv2_file, uni_file, output_fs_dir=None, gdc_coeff_file=No
     # define directory for Freeseurfer
     fs_dir = derivatives_path
     sub = 'freesurfer'
-        
-    # autorecon1 without skullstrip removal (~11 mins) - added -gcut flag to exclude dura
-    os.system("recon-all" + \
-          " -i " + uni_mprageized_file + \
-          " -hires" + \
-          " -autorecon1" + \
-          " -noskullstrip" + \
-          " -gcut" + \
-          " -sd " + fs_dir + \
-          " -s " + sub + \
-          " -parallel")
-    print("****** auto recon 1 is complete")
-
-    # apply brain mask from CAT12 or synthstrip
-    transmask = ApplyVolTransform()
-    transmask.inputs.source_file = brainmask_filepath
-    transmask.inputs.target_file = os.path.join(fs_dir, sub, 'mri', 'orig.mgz')
-    transmask.inputs.reg_header = True
-    transmask.inputs.interp = "nearest"
-    transmask.inputs.transformed_file = os.path.join(fs_dir, sub, 'mri', 'brainmask_mask.mgz')
-    transmask.inputs.args = "--no-save-reg"
-    transmask.run(cwd=cwd)
-    print("****** applying brain mask from CAT12 or synthstrip is complete")
-
-    applymask = ApplyMask()
-    applymask.inputs.in_file = os.path.join(fs_dir, sub,'mri','T1.mgz')
-    applymask.inputs.mask_file = os.path.join(fs_dir, sub, 'mri', 'brainmask_mask.mgz')
-    applymask.inputs.out_file =  os.path.join(fs_dir, sub, 'mri', 'brainmask.mgz')
-    applymask.run(cwd=cwd)
-    print("****** apply mask is complete")
-
-    shutil.copy2(os.path.join(fs_dir, sub, 'mri', 'brainmask.mgz'),
-                 os.path.join(fs_dir, sub, 'mri', 'brainmask.auto.mgz'))
-
-    # continue recon-all
-    with open(os.path.join(derivatives_path,'expert.opts'), 'w') as text_file:
-        text_file.write('mris_inflate -n 100\n')
-        print("****** expert option saved as text file")
-    
-    # autorecon 2 and 3 - added -gcut flag to exclude dura
-    os.system("recon-all" + \
-              " -hires" + \
-              " -autorecon2" + " -autorecon3"\
-              " -gcut" + \
-              " -sd " + fs_dir + \
-              " -s " + sub + \
-              " -expert " + os.path.join(derivatives_path,'expert.opts') + \
-              " -xopts-overwrite" + \
-              " -parallel")
-    print("****** auto recon 2 and 3 are complete")
+    mri_dir = os.path.join(fs_dir, sub, 'mri')
+
+    # recon-all works on a copy of the subject dir on node-local scratch when given (see scratch.py);
+    # stage markers and final outputs stay in fs_dir
+    workspace = scratch.new_workspace(scratch_dir, fs_dir, sub, f"{subject_foldername}_{session_name}")
+    work_mri_dir = os.path.join(workspace['work_subject_dir'], 'mri')
+
+    # Thread budget of recon-all -parallel when it runs alone
+    threads_flags = ["-threads", str(threads)] if threads else []
+
+    # The stage sequence runs in try/finally, so a failed stage still gets its recon-all.log/.error synced
+    # back and the checkpoint thread stopped
+    try:
+        # autorecon1 only needs the MPRAGEized image, so it runs in the background while the brain is extracted;
+        # the two branches are joined before the brain mask is applied
+        # autorecon1 without skullstrip removal (~11 mins) - added -gcut flag to exclude dura
+        autorecon1 = None
+        autorecon1_flags = "-hires -autorecon1 -noskullstrip -gcut -parallel"
+        run_autorecon1 = stages.should_run(state, 'autorecon1', [uni_mprageized_file], {'flags': autorecon1_flags},
+                                           [os.path.join(mri_dir, 'orig.mgz'), os.path.join(mri_dir, 'T1.mgz')])
+        run_skullstrip = stages.should_run(state, 'skullstrip', [uni_mprageized_file], {'method': skull_strip_method},
+                                           skullstrip_outputs)
+
+        # While both branches run they share the --threads budget, otherwise each stage gets all of it
+        autorecon1_threads, skullstrip_threads = threads, threads
+        if run_autorecon1 and run_skullstrip and threads:
+            autorecon1_threads = math.ceil(threads / 2)
+            skullstrip_threads = max(1, threads - autorecon1_threads)
+            print(f"****** threads while autorecon1 and skullstrip overlap: {autorecon1_threads} + {skullstrip_threads}")
+
+        if run_autorecon1:
+            # recon-all -i refuses to overwrite an existing subject, so a rerun starts from a clean subject dir
+            scratch.reset(workspace)
+            autorecon1 = runner.start_stage('autorecon1', ["recon-all",
+                                                           "-i", uni_mprageized_file,
+                                                           "-hires",
+                                                           "-autorecon1",
+                                                           "-noskullstrip",
+                                                           "-gcut",
+                                                           "-sd", workspace['work_fs_dir'],
+                                                           "-s", sub,
+                                                           "-parallel"]
+                                                          + (["-threads", str(autorecon1_threads)] if threads else []),
+                                            report['log_dir'])
+            print("****** auto recon 1 started")
+
+        # periodic syncs of the working copy back to fs_dir while recon-all runs
+        scratch.start_checkpoints(workspace, checkpoint_interval)
+
+
+        ####################################################
+        ## Brain extraction either by CAT12 or Synthstrip ##
+        ####################################################    
+        # Synthstrip performs skullstripping #
+        # CAT12 performs GM and WM segmentation and then combines them #
+        try:
+            if run_skullstrip:
+                if skull_strip_method == 'synthstrip':
+                    # Call mri_synthstrip function on bias corrected image
+                    brain_file, brainmask_filepath = mri_synthstrip(uni_mprageized_file, derivatives_path,
+                                                                    log_dir=report['log_dir'], report=report, threads=skullstrip_threads)
+                    print("skull removing and brain mask creation via synthstrip is complete!!!!!")
+
+                else:
+                    cat12_output_dir=os.path.join(derivatives_path,'mri')
+                    with runner.timed_stage('cat12', report):
+                        gm_file, wm_file = cat12_seg(uni_mprageized_file, cat12_output_dir, skullstrip_threads)
+                    print("****** CAT12 complete")
+
+                stages.mark_done(state, 'skullstrip')
+
+            # Fuse the CAT12 GM and WM maps into the brain mask
+            if skull_strip_method == 'cat12' and stages.should_run(state, 'maskfusion', [gm_file, wm_file, uni_mprageized_file],
+                                                                   mask_cleanup, [brainmask_filepath, uni_mprageized_brain_filepath]):
+                with runner.timed_stage('maskfusion', report):
+                    fuse_brain_mask(gm_file, wm_file, uni_mprageized_file, brainmask_filepath, uni_mprageized_brain_filepath, **mask_cleanup)
+                stages.mark_done(state, 'maskfusion')
+        except BaseException:
+            # Do not leave recon-all running when the brain extraction fails
+            if autorecon1 is not None:
+                runner.stop_stage(autorecon1)
+            raise
+
+        # join autorecon1 before the brain mask is applied
+        if autorecon1 is not None:
+            runner.finish_stage(autorecon1, report)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'autorecon1')
+            print("****** auto recon 1 is complete")
+
+        # apply brain mask from CAT12 or synthstrip
+        if stages.should_run(state, 'brainmask', [brainmask_filepath, os.path.join(mri_dir, 'T1.mgz')],
+                             {'mask_resampling': mask_resampling},
+                             [os.path.join(mri_dir, 'brainmask.mgz'), os.path.join(mri_dir, 'brainmask.auto.mgz')]):
+            scratch.stage_in(workspace)
+            with runner.timed_stage('brainmask', report):
+                if mask_resampling == 'freesurfer':
+                    from nipype.interfaces.freesurfer import ApplyVolTransform, ApplyMask
+                    transmask = ApplyVolTransform()
+                    transmask.inputs.source_file = brainmask_filepath
+                    transmask.inputs.target_file = os.path.join(work_mri_dir, 'orig.mgz')
+                    transmask.inputs.reg_header = True
+                    transmask.inputs.interp = "nearest"
+                    transmask.inputs.transformed_file = os.path.join(work_mri_dir, 'brainmask_mask.mgz')
+                    transmask.inputs.args = "--no-save-reg"
+                    transmask.run(cwd=cwd)
+                    print("****** applying brain mask from CAT12 or synthstrip is complete")
+
+                    applymask = ApplyMask()
+                    applymask.inputs.in_file = os.path.join(work_mri_dir, 'T1.mgz')
+                    applymask.inputs.mask_file = os.path.join(work_mri_dir, 'brainmask_mask.mgz')
+                    applymask.inputs.out_file =  os.path.join(work_mri_dir, 'brainmask.mgz')
+                    applymask.run(cwd=cwd)
+                    print("****** apply mask is complete")
+
+                    shutil.copy2(os.path.join(work_mri_dir, 'brainmask.mgz'),
+                                 os.path.join(work_mri_dir, 'brainmask.auto.mgz'))
+                else:
+                    apply_brain_mask(brainmask_filepath, work_mri_dir)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'brainmask')
+
+        # continue recon-all
+        with open(os.path.join(derivatives_path,'expert.opts'), 'w') as text_file:
+            text_file.write('mris_inflate -n 100\n')
+            print("****** expert option saved as text file")
+
+        # autorecon 2 and 3 - added -gcut flag to exclude dura
+        autorecon23_flags = "-hires -autorecon2 -autorecon3 -gcut -xopts-overwrite -parallel"
+        if stages.should_run(state, 'autorecon23', [os.path.join(mri_dir, 'brainmask.mgz'), os.path.join(derivatives_path, 'expert.opts')],
+                             {'flags': autorecon23_flags},
+                             [os.path.join(mri_dir, 'aparc+aseg.mgz'), os.path.join(fs_dir, sub, 'surf', 'lh.pial'),
+                              os.path.join(fs_dir, sub, 'surf', 'rh.pial')]):
+            scratch.stage_in(workspace)
+            runner.run_stage('autorecon23', ["recon-all",
+                                             "-hires",
+                                             "-autorecon2", "-autorecon3",
+                                             "-gcut",
+                                             "-sd", workspace['work_fs_dir'],
+                                             "-s", sub,
+                                             "-expert", os.path.join(derivatives_path,'expert.opts'),
+                                             "-xopts-overwrite",
+                                             "-parallel"] + threads_flags, report['log_dir'], report)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'autorecon23')
+            print("****** auto recon 2 and 3 are complete")
+    finally:
+        # stop the checkpoint syncs, sync back and free the node-local scratch
+        scratch.finish(workspace)
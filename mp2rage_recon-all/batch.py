@@ -0,0 +1,167 @@
+##########################################################
+## Multi-subject batch driver with a local scheduler ##
+##########################################################
+# Runs all subjects of config.txt ("sub-X SESSION" per line) on one node. Every subject runs in two phases
+# of mp2rage_recon-all.py: 'prepare' (mprageize, skullstrip, maskfusion) on one core, and 'recon' (autorecon1
+# to autorecon23, resumed through the stage markers) with --threads cores. Up to --max-parallel recon-alls
+# run at once, and the cheap prepare phases of the next subjects overlap with them on the remaining cores.
+# Running phases never use more than --cores together; only a single phase on an idle node may exceed it.
+
+import os
+import sys
+import json
+import time
+import argparse
+
+import runner
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mp2rage_recon-all.py')
+
+# Same layout as mp2rage_preprocessing.sh
+INV2_TEMPLATE = "{study_dir}/{subject}/ses-{session}/anat/{subject}_ses-{session}_inv-2_MP2RAGE.nii"
+UNI_TEMPLATE = "{study_dir}/{subject}/ses-{session}/anat/{subject}_ses-{session}_UNIT1.nii"
+STATUS_FILENAME = 'batch_status.json'
+STOP_TIMEOUT = 10 * runner.STOP_TIMEOUT
+
+
+def read_config(config_file):
+    with open(config_file) as f:
+        return [tuple(line.split()[:2]) for line in f if line.strip()]
+
+
+def default_cores():
+    cores = os.environ.get('SLURM_CPUS_PER_TASK')
+    return int(cores) if cores else os.cpu_count()
+
+
+def subject_command(job, phase, threads, forwarded):
+    cmd = [sys.executable, SCRIPT, '--inv2', job['inv2'], '--uni', job['uni']] + forwarded
+    if phase == 'prepare':
+        return cmd + ['--threads', '1', '--until-stage', 'maskfusion']
+    return cmd + ['--threads', str(threads)]
+
+
+def write_status(batch_dir, jobs):
+    status = {job['name']: {key: job[key] for key in ('subject', 'session', 'status', 'prepare_wall_s', 'recon_wall_s', 'error')}
+              for job in jobs}
+    with open(os.path.join(batch_dir, STATUS_FILENAME), 'w') as f:
+        json.dump(status, f, indent=2)
+
+
+def run_batch(config_file, study_dir, batch_dir, forwarded, threads=4, max_parallel=None, prepare_parallel=None,
+              cores=None, inv2_template=INV2_TEMPLATE, uni_template=UNI_TEMPLATE):
+
+    # Core budget: the prepare slots are reserved first (one by default) and the recon-alls get the rest. With no
+    # prepare slot left (e.g. threads >= cores) a prepare phase runs only while its core is free
+    cores = cores or default_cores()
+    if max_parallel is None:
+        max_parallel = max(1, (cores - (1 if prepare_parallel is None else prepare_parallel)) // threads)
+    if prepare_parallel is None:
+        prepare_parallel = max(0, cores - max_parallel * threads)
+    print(f"****** batch: {cores} cores, {max_parallel} x recon-all with {threads} threads, {prepare_parallel} x prepare")
+
+    os.makedirs(batch_dir, exist_ok=True)
+    report = runner.new_report(batch_dir, threads=threads)
+
+    jobs = []
+    for subject, session in read_config(config_file):
+        job = {'subject': subject, 'session': session, 'name': f"{subject}_ses-{session}", 'status': 'queued',
+               'prepare_wall_s': None, 'recon_wall_s': None, 'error': None,
+               'inv2': inv2_template.format(study_dir=study_dir, subject=subject, session=session),
+               'uni': uni_template.format(study_dir=study_dir, subject=subject, session=session)}
+        missing = [path for path in (job['inv2'], job['uni']) if not os.path.exists(path)]
+        if missing:
+            job['status'], job['error'] = 'skipped', f"missing {', '.join(missing)}"
+            print(f"****** {job['name']}: skipped, {job['error']}")
+        jobs.append(job)
+
+    to_prepare = [job for job in jobs if job['status'] == 'queued']
+    to_recon = []
+    running = {}
+    start = time.perf_counter()
+
+    def running_count(phase):
+        return sum(running_phase == phase for _, _, running_phase in running.values())
+
+    # A phase starts only if it fits in the cores left by the running ones, or if nothing runs at all
+    def fits(phase_cores):
+        used = threads * running_count('recon') + running_count('prepare')
+        return not running or used + phase_cores <= cores
+
+    def launch(job, phase):
+        handle = runner.start_stage(f"{job['name']}_{phase}", subject_command(job, phase, threads, forwarded),
+                                    report['log_dir'])
+        running[handle['name']] = (handle, job, phase)
+        job['status'] = 'preparing' if phase == 'prepare' else 'recon-all'
+
+    try:
+        while to_prepare or to_recon or running:
+            # recon-all first, it is the long multi-threaded part; then the prepare phases of the next subjects
+            while to_recon and running_count('recon') < max_parallel and fits(threads):
+                launch(to_recon.pop(0), 'recon')
+            while to_prepare and running_count('prepare') < max(prepare_parallel, 1) and fits(1):
+                launch(to_prepare.pop(0), 'prepare')
+            write_status(batch_dir, jobs)
+
+            handle = runner.wait_any([handle for handle, _, _ in running.values()])
+            _, job, phase = running.pop(handle['name'])
+            try:
+                entry = runner.finish_stage(handle, report)
+            except RuntimeError as e:
+                job['status'], job['error'] = 'failed', str(e)
+                job[phase + '_wall_s'] = report['stages'][-1]['wall_s']
+                print(f"****** {job['name']}: {phase} failed, see {handle['log_file']}")
+                continue
+
+            job[phase + '_wall_s'] = entry['wall_s']
+            if phase == 'prepare':
+                job['status'] = 'prepared'
+                to_recon.append(job)
+            else:
+                job['status'] = 'done'
+            print(f"****** {job['name']}: {phase} done in {entry['wall_s']} s "
+                  f"({len(running)} running, {len(to_prepare) + len(to_recon)} waiting)")
+    except BaseException:
+        # Do not leave subjects running when the driver is interrupted
+        # Subjects get SIGTERM and time to stop recon-all and sync their scratch copy before they are killed
+        runner.stop_stages([handle for handle, _, _ in running.values()], STOP_TIMEOUT)
+        for _, job, _ in running.values():
+            job['status'] = 'interrupted'
+        raise
+    finally:
+        write_status(batch_dir, jobs)
+
+    # Per-subject summary
+    print(f"\n****** batch finished in {time.perf_counter() - start:.0f} s")
+    for job in jobs:
+        print(f"{job['name']:<20} {job['status']:<12} prepare: {job['prepare_wall_s']} s  recon: {job['recon_wall_s']} s"
+              + (f"  ({job['error']})" if job['error'] else ""))
+    return jobs
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog="mp2rage_recon-all.py batch",
+        description="runs mp2rage_recon-all for all subjects of a config file on the local node; "
+                    "options not listed here (e.g. --skull-strip) are passed on to every subject"
+    )
+    parser.add_argument("--config", required=True, help="config file with 'subject session' per line")
+    parser.add_argument("--study-dir", required=True, help="BIDS directory with the MP2RAGE data")
+    parser.add_argument("--batch-dir", default="mp2rage_batch", help="logs, timing report and batch_status.json")
+    parser.add_argument("--threads", type=int, default=4, help="threads of each recon-all")
+    parser.add_argument("--max-parallel", type=int, help="concurrent recon-alls (default: (cores - prepare slots) / threads)")
+    parser.add_argument("--prepare-parallel", type=int,
+                        help="cores reserved for concurrent prepare phases (default: 1, or the cores --max-parallel leaves)")
+    parser.add_argument("--cores", type=int, help="cores of the node (default: SLURM_CPUS_PER_TASK or all)")
+    parser.add_argument("--inv2-template", default=INV2_TEMPLATE, help="INV2 path with {study_dir}, {subject} and {session}")
+    parser.add_argument("--uni-template", default=UNI_TEMPLATE, help="UNI path with {study_dir}, {subject} and {session}")
+    args, forwarded = parser.parse_known_args(argv)
+    if args.max_parallel is not None and args.max_parallel < 1:
+        parser.error("--max-parallel must be at least 1")
+    if args.prepare_parallel is not None and args.prepare_parallel < 0:
+        parser.error("--prepare-parallel must not be negative")
+    runner.raise_on_sigterm()
+
+    jobs = run_batch(args.config, args.study_dir, args.batch_dir, forwarded, args.threads, args.max_parallel,
+                     args.prepare_parallel, args.cores, args.inv2_template, args.uni_template)
+    return 0 if all(job['status'] == 'done' for job in jobs) else 1
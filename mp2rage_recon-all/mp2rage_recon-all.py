@@ -1,8 +1,19 @@
 #! /usr/bin/env python3
+import os
+import sys
+# The stage runner and scratch handling are shared with the other pipeline through the common folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
 import anatomy
+import runner
+import scratch
+import batch
 import argparse
 
 if __name__ == "__main__":
+    # "batch" subcommand: all subjects of a config file on the local node (see batch.py)
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(batch.main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(
         description="mp2rage_recon-all: runs modified FreeSurfer recon-all pipeline on MP2RAGE data "
     )
@@ -21,12 +32,68 @@ if __name__ == "__main__":
             "--skull-strip", type=str, choices=['synthstrip', 'cat12'], required=True,
             help="choose the skull stripping method: 'synthstrip' or 'cat12'"
         )
+    parser.add_argument(
+        "--save-intermediates", action="store_true",
+        help="write gzipped MPRAGEise intermediates to intermediate_outputs_mpragization"
+    )
+    parser.add_argument(
+        "--bias-correction", type=str, choices=list(anatomy.BIAS_PROVIDERS), default='spm',
+        help="INV2 bias field for MPRAGEise: SPM NewSegment (default), --bias-field file, or a polynomial estimate"
+    )
+    parser.add_argument(
+        "--bias-field", type=str, help="precomputed INV2 bias field for --bias-correction file"
+    )
+    parser.add_argument(
+        "--from-stage", type=str, choices=anatomy.STAGES,
+        help="rerun the pipeline from this stage on, skipping the earlier stages"
+    )
+    parser.add_argument(
+        "--until-stage", type=str, choices=anatomy.STAGES,
+        help="stop after this stage"
+    )
+    parser.add_argument(
+        "--threads", type=int,
+        help="threads for recon-all, synthstrip and the MATLAB runtime (default: SLURM_CPUS_PER_TASK)"
+    )
+    parser.add_argument(
+        "--fill-holes", action="store_true", help="fill holes in the fused CAT12 brain mask"
+    )
+    parser.add_argument(
+        "--largest-component", action="store_true", help="keep only the largest connected component of the fused CAT12 brain mask"
+    )
+    parser.add_argument(
+        "--mask-resampling", choices=["nibabel", "freesurfer"], default="nibabel",
+        help="resample and apply the brain mask in Python (default) or with mri_vol2vol/mri_mask for regression checks"
+    )
+    parser.add_argument(
+        "--scratch-dir", type=str, default=scratch.default_scratch_dir(),
+        help="node-local directory for the recon-all subject dir, synced back to the derivatives (default: $SLURM_TMPDIR or $TMPDIR)"
+    )
+    parser.add_argument(
+        "--no-scratch", action="store_true", help="run recon-all directly in the derivatives directory"
+    )
+    parser.add_argument(
+        "--checkpoint-interval", type=float, default=scratch.CHECKPOINT_INTERVAL / 60,
+        help="minutes between checkpoint syncs from the scratch directory (0 disables them)"
+    )
     args = parser.parse_args()
+    runner.raise_on_sigterm()
 
     anatomy.mp2rage_recon_all(
         args.inv2,
         args.uni,
         output_fs_dir=args.fs_dir,
         gdc_coeff_file=args.gdc_coeff_file,
-        skull_strip_method = args.skull_strip
+        skull_strip_method = args.skull_strip,
+        save_intermediates = args.save_intermediates,
+        bias_correction = args.bias_correction,
+        bias_field_file = args.bias_field,
+        from_stage = args.from_stage,
+        until_stage = args.until_stage,
+        threads = args.threads,
+        fill_holes = args.fill_holes,
+        largest_component = args.largest_component,
+        mask_resampling = args.mask_resampling,
+        scratch_dir = None if args.no_scratch else args.scratch_dir,
+        checkpoint_interval = args.checkpoint_interval * 60
     )
@@ -0,0 +1,168 @@
+###############################################
+## MPRAGEise core on arrays (no SPM / MATLAB) ##
+###############################################
+# Based on Sri Kashyap (https://github.com/srikash/presurfer/blob/main/func/presurf_MPRAGEise.m)
+# mprageised = normalized(bias corrected INV2) * rescaled(UNI)
+# All arrays are processed in slabs along the last axis in float32. Every input is read once, and the value
+# ranges for image_stats.txt are collected in the same passes.
+
+import argparse
+import numpy as np
+import nibabel as nib
+
+CHUNK_SLICES = 32
+
+
+def slabs(shape, chunk_size=CHUNK_SLICES):
+    for start in range(0, shape[-1], chunk_size):
+        yield (Ellipsis, slice(start, start + chunk_size))
+
+
+# (min, max) of value_range extended by chunk; NaN propagates, so a NaN in the image shows up in its range
+def extend_range(value_range, chunk):
+    return float(np.minimum(value_range[0], chunk.min())), float(np.maximum(value_range[1], chunk.max()))
+
+
+def mprageise(inv2_corrected, uni, chunk_size=CHUNK_SLICES, inv2=None, keep_intermediates=False):
+    """
+    Pure array core of the MPRAGEise stage.
+    inv2_corrected: bias corrected INV2, uni: UNI image (any array-like supporting slicing, e.g. dataobj).
+    inv2: the original INV2, only for its range in the stats when no NumPy bias field provider has read it (SPM).
+    Returns the float32 MPRAGEised image, the value ranges used for image_stats.txt and, with keep_intermediates,
+    the float32 bias corrected INV2, normalized INV2 and rescaled UNI for the intermediate outputs.
+    The first pass reads every input once, copies INV2 and UNI to float32 and collects their ranges; the second
+    normalises and multiplies in memory and measures the ranges of its results. An INV2 that is already a float32 array (the NumPy bias field providers)
+    is used as is, otherwise it takes one extra float32 volume.
+    """
+    if inv2_corrected.shape != uni.shape:
+        raise ValueError(f"INV2 and UNI shapes differ: {inv2_corrected.shape} vs {uni.shape}")
+
+    out = np.empty(uni.shape, dtype=np.float32)
+    in_memory = isinstance(inv2_corrected, np.ndarray) and inv2_corrected.dtype == np.float32
+    inv2_data = inv2_corrected if in_memory else np.empty(uni.shape, dtype=np.float32)
+    stats = {'bias_corrected_inv2': (np.inf, -np.inf), 'uni': (np.inf, -np.inf)}
+    if inv2 is not None:
+        stats['inv2'] = (np.inf, -np.inf)
+    for slab in slabs(uni.shape, chunk_size):
+        inv2_chunk, uni_chunk = np.asarray(inv2_corrected[slab]), np.asarray(uni[slab])
+        stats['bias_corrected_inv2'] = extend_range(stats['bias_corrected_inv2'], inv2_chunk)
+        stats['uni'] = extend_range(stats['uni'], uni_chunk)
+        if inv2 is not None:
+            stats['inv2'] = extend_range(stats['inv2'], np.asarray(inv2[slab]))
+        if not in_memory:
+            inv2_data[slab] = inv2_chunk
+        out[slab] = uni_chunk
+
+    intermediates = {}
+    if keep_intermediates:
+        intermediates = {'bias_corrected_inv2': inv2_data, 'normalized_inv2': np.empty(uni.shape, dtype=np.float32),
+                         'rescaled_uni': np.empty(uni.shape, dtype=np.float32)}
+    inv2_range, uni_range = stats['bias_corrected_inv2'], stats['uni']
+    for name in ('normalized_inv2', 'rescaled_uni', 'mprageised'):
+        stats[name] = (np.inf, -np.inf)
+    for slab in slabs(uni.shape, chunk_size):
+        inv2_chunk = np.subtract(inv2_data[slab], inv2_range[0], dtype=np.float32)
+        inv2_chunk /= inv2_range[1] - inv2_range[0]
+        out_chunk = out[slab]
+        out_chunk -= uni_range[0]
+        out_chunk /= uni_range[1] - uni_range[0]
+        stats['normalized_inv2'] = extend_range(stats['normalized_inv2'], inv2_chunk)
+        stats['rescaled_uni'] = extend_range(stats['rescaled_uni'], out_chunk)
+        if keep_intermediates:
+            intermediates['normalized_inv2'][slab] = inv2_chunk
+            intermediates['rescaled_uni'][slab] = out_chunk
+        out_chunk *= inv2_chunk
+        stats['mprageised'] = extend_range(stats['mprageised'], out_chunk)
+
+    return out, stats, intermediates
+
+
+## Bias field providers ##
+# Each is called as provider(inv2, **options) with INV2 as a data proxy or array and ignores the options it does
+# not use. It reads INV2 once and returns the bias corrected INV2 as a float32 array together with the (min, max)
+# of the original INV2. BIAS_PROVIDERS below maps the --bias-correction names to them; anatomy.py adds SPM NewSegment.
+
+# Precomputed multiplicative bias field (INV2 = corrected INV2 * bias field); out=inv2 corrects a float32 INV2 in place
+def apply_bias_field(inv2, bias_field, chunk_size=CHUNK_SLICES, out=None):
+    if inv2.shape != bias_field.shape:
+        raise ValueError(f"INV2 and bias field shapes differ: {inv2.shape} vs {bias_field.shape}")
+    out = np.empty(inv2.shape, dtype=np.float32) if out is None else out
+    inv2_range = (np.inf, -np.inf)
+    for slab in slabs(inv2.shape, chunk_size):
+        inv2_chunk = np.asarray(inv2[slab])
+        inv2_range = extend_range(inv2_range, inv2_chunk)
+        field = np.asarray(bias_field[slab], dtype=np.float32)
+        np.divide(inv2_chunk.astype(np.float32, copy=False), field, out=out[slab], where=field > 0)
+        out[slab][field <= 0] = 0
+    return out, inv2_range
+
+
+def bias_field_file_correction(inv2, bias_field_file=None, chunk_size=CHUNK_SLICES, **options):
+    if bias_field_file is None:
+        raise ValueError("The 'file' bias correction needs a bias field file (--bias-field)")
+    return apply_bias_field(inv2, nib.load(bias_field_file).dataobj, chunk_size)
+
+
+# Smooth polynomial bias field fitted to log intensities of the head (fast stand-in for N4 / SPM)
+def polynomial_bias_field(inv2, order=3, sampling=4, chunk_size=CHUNK_SLICES):
+
+    # Fit on a subsampled grid, using voxels above the mean intensity as the head
+    sample = np.asarray(inv2[::sampling, ::sampling, ::sampling], dtype=np.float32)
+    mask = sample > sample[sample > 0].mean()
+    axes = [np.linspace(-1, 1, n, dtype=np.float32) for n in inv2.shape]
+    powers = [(i, j, k) for i in range(order + 1) for j in range(order + 1 - i) for k in range(order + 1 - i - j)]
+
+    sample_axes = [axis[::sampling] for axis in axes]
+    coords = np.nonzero(mask)
+    design = np.stack([sample_axes[0][coords[0]] ** i * sample_axes[1][coords[1]] ** j * sample_axes[2][coords[2]] ** k
+                       for i, j, k in powers], axis=1)
+    log_intensity = np.log(sample[mask])
+    coefficients = np.linalg.lstsq(design, log_intensity - log_intensity.mean(), rcond=None)[0]
+
+    # Evaluate the field slab by slab on the full grid
+    field = np.zeros(inv2.shape, dtype=np.float32)
+    for slab in slabs(inv2.shape, chunk_size):
+        z = axes[2][slab[1]]
+        for (i, j, k), coefficient in zip(powers, coefficients):
+            field[slab] += (coefficient * axes[0][:, None, None] ** i * axes[1][None, :, None] ** j
+                            * z[None, None, :] ** k).astype(np.float32)
+        np.exp(field[slab], out=field[slab])
+    return field
+
+
+# INV2 is read once into float32; the field is fitted on that copy and divided out of it in place
+def polynomial_correction(inv2, order=3, chunk_size=CHUNK_SLICES, **options):
+    data = np.empty(inv2.shape, dtype=np.float32)
+    for slab in slabs(inv2.shape, chunk_size):
+        data[slab] = inv2[slab]
+    return apply_bias_field(data, polynomial_bias_field(data, order, chunk_size=chunk_size), chunk_size, out=data)
+
+
+BIAS_PROVIDERS = {'file': bias_field_file_correction, 'polynomial': polynomial_correction}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MPRAGEise INV2 and UNI without SPM")
+    parser.add_argument("--inv2", required=True, help="INV2 image (already bias corrected unless a provider is chosen)")
+    parser.add_argument("--uni", required=True, help="UNI image")
+    parser.add_argument("--out", required=True, help="output MPRAGEised image")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--bias-field", help="precomputed bias field for INV2")
+    group.add_argument("--polynomial-order", type=int, help="estimate a polynomial bias field of this order")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SLICES, help="slices per slab")
+    args = parser.parse_args()
+
+    inv2_img = nib.load(args.inv2)
+    uni_img = nib.load(args.uni)
+    if args.bias_field:
+        inv2_corrected, inv2_range = bias_field_file_correction(inv2_img.dataobj, args.bias_field, args.chunk_size)
+    elif args.polynomial_order is not None:
+        inv2_corrected, inv2_range = polynomial_correction(inv2_img.dataobj, args.polynomial_order, args.chunk_size)
+    else:
+        inv2_corrected, inv2_range = inv2_img.dataobj, None
+
+    mprageised, stats, _ = mprageise(inv2_corrected, uni_img.dataobj, args.chunk_size)
+    if inv2_range is not None:
+        stats['inv2'] = inv2_range
+    nib.save(nib.Nifti1Image(mprageised, uni_img.affine, uni_img.header), args.out)
+    print(stats)
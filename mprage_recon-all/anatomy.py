@@ -2,13 +2,9 @@
 ## Preprocessing Pipeline for MPRAGE ##
 #######################################
 
-from nipype.interfaces import spm
-from nipype.interfaces import matlab
-from nipype.interfaces import cat12
-from nipype.interfaces.freesurfer import ApplyVolTransform, ApplyMask
-import nipype.pipeline.engine as pe
 import nibabel as nib
 import numpy as np
+from scipy import ndimage
 import os
 import sys
 import gzip
@@ -17,16 +13,48 @@ import subprocess
 from tempfile import TemporaryDirectory
 import tempfile
 
+# NIfTI loaders, stage markers, the stage runner and scratch handling are shared with the other pipeline
+# through the common folder at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import nifti_io
+import stages
+import runner
+import scratch
+
+
+# Pipeline stages in execution order, each with a completion marker (see stages.py)
+STAGES = ['bias_correction', 'skullstrip', 'maskfusion', 'autorecon1', 'brainmask', 'autorecon23']
 
 matlab_cmd = '/opt/spm12/run_spm12.sh /opt/mcr/v93 script'
 spm_path = '/opt/spm12/spm12_mcr/home/gaser/gaser/spm/spm12'
-spm.SPMCommand.set_mlab_paths(matlab_cmd=matlab_cmd, use_mcr=True)
+mcr_configured = False
+
+# nipype's SPM interfaces are imported and pointed at the MCR on first use, so runs without SPM/CAT12
+# stages (synthstrip, --help) do not pay for it; see import_benchmark.py
+def spm_interfaces():
+    global mcr_configured
+    from nipype.interfaces import spm
+    if not mcr_configured:
+        spm.SPMCommand.set_mlab_paths(matlab_cmd=matlab_cmd, use_mcr=True)
+        mcr_configured = True
+    return spm
 
 def set_spm_path(new_spm_path):
+    from nipype.interfaces import matlab
     global spm_path
     spm_path = new_spm_path
     matlab.MatlabCommand.set_default_paths(spm_path)
 
+# Default thread budget: the CPUs SLURM gave this task, otherwise the tools' own defaults
+def default_threads():
+    threads = os.environ.get('SLURM_CPUS_PER_TASK')
+    return int(threads) if threads else None
+
+# Limit the MATLAB runtime of an SPM/CAT12 interface to a number of computational threads
+def limit_mcr_threads(interface, threads):
+    if threads:
+        interface.mlab.inputs.prescript = list(interface.mlab.inputs.prescript) + [f"maxNumCompThreads({threads});"]
+
 def check_spm_path():
     print(spm_path)
     
@@ -38,7 +66,7 @@ def load_niimg(niimg):
 
 def normalize(niimg_in,out_file=None):
     niimg_in = load_niimg(niimg_in)
-    data = niimg_in.get_fdata()
+    data = nifti_io.load_image(niimg_in)
     data_norm = (data-np.min(data))/(np.max(data)-np.min(data))
     niimg_out = nib.Nifti1Image(data_norm,niimg_in.affine,niimg_in.header)
     if out_file:
@@ -48,8 +76,8 @@ def normalize(niimg_in,out_file=None):
 def multiply(niimg_in1, niimg_in2, out_file=None):
     niimg_in1 = load_niimg(niimg_in1)
     niimg_in2 = load_niimg(niimg_in2)
-    data1 = niimg_in1.get_fdata()
-    data2 = niimg_in2.get_fdata()
+    data1 = nifti_io.load_image(niimg_in1)
+    data2 = nifti_io.load_image(niimg_in2)
     data_mult = data1 * data2
     niimg_out = nib.Nifti1Image(data_mult,niimg_in1.affine,niimg_in1.header)
     if out_file:
@@ -57,7 +85,7 @@ def multiply(niimg_in1, niimg_in2, out_file=None):
     return niimg_out
 
 
-def bias_correction(mprage_file, out_file = None):
+def bias_correction(mprage_file, out_file = None, threads=None):
 
     # Check if the input file exists
     if not os.path.exists(mprage_file):
@@ -82,7 +110,7 @@ def bias_correction(mprage_file, out_file = None):
         shutil.copyfile(nii_file, copied_input)
 
         # Create SPM object with specific parameters
-        seg = spm.NewSegment()
+        seg = spm_interfaces().NewSegment()
         seg.inputs.channel_files = copied_input
         seg.inputs.channel_info = (0.001, 40, (False, True))
         tissue1 = ((os.path.join(spm_path,'tpm','TPM.nii'), 1), 2, (False,False), (False, False))
@@ -98,6 +126,7 @@ def bias_correction(mprage_file, out_file = None):
         seg.inputs.write_deformation_fields = [True, True]
 
         # Perform bias correction
+        limit_mcr_threads(seg, threads)
         seg_results = seg.run(cwd = os.path.dirname(os.path.abspath(out_file)))
 
         # Extract the path of the bias correction from seg_results
@@ -111,7 +140,7 @@ def bias_correction(mprage_file, out_file = None):
 
 
 
-def cat12_seg(in_file, cat12_output_dir):
+def cat12_seg(in_file, cat12_output_dir, threads=None):
 
     # CAT12 segmentation using temporary memory
     with TemporaryDirectory() as tmpdirname:
@@ -125,6 +154,8 @@ def cat12_seg(in_file, cat12_output_dir):
         median_res = np.median(img.header.get_zooms()[:3])
         
         # Create CAT12 object with specific parameters
+        spm_interfaces()
+        from nipype.interfaces import cat12
         cat12_segment = cat12.CAT12Segment(in_files = copied_input)
         cat12_segment.inputs.internal_resampling_process = (median_res, 0.1)
         cat12_segment.inputs.surface_and_thickness_estimation = 0
@@ -150,6 +181,7 @@ def cat12_seg(in_file, cat12_output_dir):
         cat12_segment.inputs.output_labelnative = True
         # cat12_segment.inputs.output_surface = False
         # cat12_segment.inputs.no_surf = True
+        limit_mcr_threads(cat12_segment, threads)
         cat12_segment.run(cwd = tmpdirname) 
 
         # Get current working directory and filename of the loaded Bias Corrected file
@@ -172,14 +204,90 @@ def cat12_seg(in_file, cat12_output_dir):
 
 
 
-def mri_synthstrip(in_file, brain_file=None):
+# Brain mask from the CAT12 GM (p1) and WM (p2) maps as uint8, applied to the T1w in place
+def fuse_brain_mask(gm_file, wm_file, image_file, brainmask_file, brain_file, fill_holes=False, largest_component=False):
+    gm_nii = nib.load(gm_file)
+    wm_nii = nib.load(wm_file)
+    image_nii = nib.load(image_file)
+
+    # Mask built slab by slab, so the GM and WM maps are never held in memory as full volumes
+    brainmask_data = np.zeros(image_nii.shape[:3], dtype=np.uint8)
+    for start in range(0, brainmask_data.shape[-1], 32):
+        slab = (Ellipsis, slice(start, start + 32))
+        brainmask_data[slab] = (np.asanyarray(gm_nii.dataobj[slab]) > 0) | (np.asanyarray(wm_nii.dataobj[slab]) > 0)
+
+    # Optional cleanup: fill enclosed holes, keep only the largest connected component
+    if fill_holes:
+        brainmask_data = ndimage.binary_fill_holes(brainmask_data).astype(np.uint8)
+    if largest_component:
+        components, n_components = ndimage.label(brainmask_data)
+        if n_components > 1:
+            sizes = np.bincount(components.ravel())
+            sizes[0] = 0
+            brainmask_data = (components == sizes.argmax()).astype(np.uint8)
+
+    mask_header = image_nii.header.copy()
+    mask_header.set_data_dtype(np.uint8)
+    nib.save(nib.Nifti1Image(brainmask_data, image_nii.affine, mask_header), brainmask_file)
+    print("****** brain mask saved")
+
+    # Brain extraction by masking the float32 T1w in place
+    brain_data = np.require(nifti_io.load_image(image_nii), requirements='W')
+    np.multiply(brain_data, brainmask_data, out=brain_data)
+    nib.save(nib.Nifti1Image(brain_data, image_nii.affine, image_nii.header), brain_file)
+    print("****** brain extraction saved")
+
+    return brainmask_file, brain_file
+
+
+# Nearest-neighbour resampling of a mask into the voxel grid of target_file through the header (scanner RAS)
+# geometry of both images, as mri_vol2vol --regheader --interp nearest; voxels mapping outside the mask are 0
+def resample_to_target(mask_file, target_file):
+    mask_img = nib.load(mask_file)
+    target_img = nib.load(target_file)
+    mask_data = nifti_io.load_labels(mask_img)
+
+    # target voxel -> mask voxel, computed one target slice at a time
+    vox2vox = np.linalg.inv(mask_img.affine) @ target_img.affine
+    shape = target_img.shape[:3]
+    i = np.arange(shape[0])[:, None]
+    j = np.arange(shape[1])[None, :]
+    resampled = np.zeros(shape, dtype=mask_data.dtype)
+    for k in range(shape[2]):
+        index = [np.floor(vox2vox[axis, 0] * i + vox2vox[axis, 1] * j + vox2vox[axis, 2] * k + vox2vox[axis, 3] + 0.5).astype(np.intp)
+                 for axis in range(3)]
+        inside = np.ones(shape[:2], dtype=bool)
+        for axis in range(3):
+            inside &= (index[axis] >= 0) & (index[axis] < mask_data.shape[axis])
+        resampled[..., k][inside] = mask_data[index[0][inside], index[1][inside], index[2][inside]]
+    return resampled
+
+# brainmask.mgz and brainmask.auto.mgz: T1.mgz with all voxels outside the resampled brain mask set to 0 (as mri_mask)
+def apply_brain_mask(brainmask_file, mri_dir):
+    t1_img = nib.load(os.path.join(mri_dir, 'T1.mgz'))
+    mask_data = resample_to_target(brainmask_file, os.path.join(mri_dir, 'orig.mgz'))
+    if mask_data.shape != t1_img.shape[:3]:
+        raise ValueError(f"orig.mgz and T1.mgz shapes differ: {mask_data.shape} vs {t1_img.shape[:3]}")
+
+    brainmask_data = np.array(t1_img.dataobj)
+    brainmask_data[mask_data == 0] = 0
+    brainmask_img = nib.MGHImage(brainmask_data, t1_img.affine, t1_img.header)
+    for filename in ('brainmask.mgz', 'brainmask.auto.mgz'):
+        nib.save(brainmask_img, os.path.join(mri_dir, filename))
+    print("****** brain mask applied to T1.mgz")
+    return os.path.join(mri_dir, 'brainmask.mgz')
+
+
+
+def mri_synthstrip(in_file, brain_file=None, log_dir=None, report=None, threads=None):
     # Generate output filename
     brain_file = os.path.join(os.path.dirname(in_file), os.path.basename(in_file).replace('_mprage_bc.nii', '_synthstrip_brain.nii'))
     mask_file = os.path.join(os.path.dirname(in_file), os.path.basename(in_file).replace('_mprage_bc.nii', '_synthstrip_brain_mask.nii'))
 
     # Run mri_synthstrip to extract brain and create mask
     cmd = ['mri_synthstrip', '-i', in_file, '-o', brain_file, '-m', mask_file, '--no-csf']
-    subprocess.run(cmd, check=True)
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads)) if threads else None
+    runner.run_stage('mri_synthstrip', cmd, log_dir or os.path.join(os.path.dirname(in_file), 'logs'), report, env)
 
     # Check if the output brain file and mask file were created
     if not os.path.exists(brain_file):
@@ -192,7 +300,9 @@ def mri_synthstrip(in_file, brain_file=None):
 
 
 
-def mprage_recon_all(mprage_file = None, skull_strip_method=None):
+def mprage_recon_all(mprage_file = None, skull_strip_method=None, from_stage=None, until_stage=None, threads=None,
+                     fill_holes=False, largest_component=False, mask_resampling='nibabel', scratch_dir=None,
+                     checkpoint_interval=scratch.CHECKPOINT_INTERVAL):
     
     #####################
     ## Bias correction ##
@@ -218,10 +328,26 @@ def mprage_recon_all(mprage_file = None, skull_strip_method=None):
     
     # Create filename and path for the bias corrected image
     bc_mprage_file = os.path.join(derivatives_path, subject_foldername + '_' + session_name + '_mprage_bc.nii') 
+
+    # Threads for recon-all, synthstrip and the MATLAB runtime; SLURM_CPUS_PER_TASK unless given
+    threads = threads or default_threads()
+    print(f"*********** Threads: {threads if threads else 'tool defaults'}")
+
+    # Optional cleanup of the fused CAT12 mask
+    mask_cleanup = {'fill_holes': fill_holes, 'largest_component': largest_component}
+
+    # Completion markers of the stages under derivatives_path/stage_markers
+    state = stages.stage_state(derivatives_path, STAGES, from_stage, until_stage)
+
+    # Per-stage logs under derivatives_path/logs and timing report derivatives_path/timing_report.json
+    report = runner.new_report(derivatives_path, subject_foldername, session_name, threads)
     
     # Perform bias correction by calling the function
-    bias_correction(mprage_file, bc_mprage_file)
-    print("************* Bias Correction complete! - Check the Derivatives folder")
+    if stages.should_run(state, 'bias_correction', [mprage_file], {}, [bc_mprage_file]):
+        with runner.timed_stage('bias_correction', report):
+            bias_correction(mprage_file, bc_mprage_file, threads)
+        stages.mark_done(state, 'bias_correction')
+        print("************* Bias Correction complete! - Check the Derivatives folder")
 
 
     ####################################################
@@ -230,47 +356,40 @@ def mprage_recon_all(mprage_file = None, skull_strip_method=None):
     # Synthstrip performs skullstripping #
     # CAT12 performs GM and WM segmentation and then combines them #
     if skull_strip_method == 'synthstrip':
-        # Call mri_synthstrip function on bias corrected image
-        brain_file, brainmask_filepath = mri_synthstrip(bc_mprage_file, derivatives_path)
-        print("skull removing and brain mask creation via synthstrip is complete!!!!!")
-    elif skull_strip_method == 'cat12': 
-        # Call CAT12 function on bias corrected image
-        cat12_output_dir = os.path.join(derivatives_path, 'mri')
-        gm_file, wm_file = cat12_seg(bc_mprage_file, cat12_output_dir)
-        print("************ CAT12 complete!!!!")  
-
-        # Load the GM and WM files (saved by CAT12) and Bias corrected file
-        gm_nii = nib.load(gm_file)
-        wm_nii = nib.load(wm_file)
-        bc_mprage_nii = nib.load(bc_mprage_file)
-        print("************ segmentations and bias correction loaded")
-
-        # Get data from these NIFTI files
-        gm_data = gm_nii.get_fdata()
-        wm_data = wm_nii.get_fdata()
-        bc_mprage_data = bc_mprage_nii.get_fdata()
-        print("************ data from segmentations and bias correction extracted")
-
-        # Creating and saving brain mask
+        brain_file = bc_mprage_file.replace('_mprage_bc.nii', '_synthstrip_brain.nii')
+        brainmask_filepath = bc_mprage_file.replace('_mprage_bc.nii', '_synthstrip_brain_mask.nii')
+        skullstrip_outputs = [brain_file, brainmask_filepath]
+    elif skull_strip_method == 'cat12':
         brainmask_filepath = os.path.join(derivatives_path, f"{subject_foldername}_{session_name}_brain_mask.nii")
-        brainmask_data = np.array(((wm_data > 0) | (gm_data > 0)),dtype=int)
-        brainmask_nii = nib.Nifti1Image(brainmask_data,
-                                        bc_mprage_nii.affine,
-                                        bc_mprage_nii.header)
-        nib.save(brainmask_nii, brainmask_filepath)
-        print("Brain mask saved")
-
-        # Creating and saving brain extraction
         bc_brain_filepath = os.path.join(derivatives_path, f"{subject_foldername}_{session_name}_bc_brain.nii")
-        brain_data = brainmask_data * bc_mprage_data
-        brain_nii = nib.Nifti1Image(brain_data, 
-                                    bc_mprage_nii.affine, 
-                                    bc_mprage_nii.header)
-        nib.save(brain_nii, bc_brain_filepath)
-        print("Brain extraction saved")
+        gm_file = os.path.join(derivatives_path, 'mri', 'p1' + os.path.basename(bc_mprage_file))
+        wm_file = os.path.join(derivatives_path, 'mri', 'p2' + os.path.basename(bc_mprage_file))
+        skullstrip_outputs = [gm_file, wm_file]
     else:
         raise ValueError("Invalid skull stripping method. Choose either 'synthstrip' or 'cat12'.")
 
+    if stages.should_run(state, 'skullstrip', [bc_mprage_file], {'method': skull_strip_method}, skullstrip_outputs):
+        if skull_strip_method == 'synthstrip':
+            # Call mri_synthstrip function on bias corrected image
+            brain_file, brainmask_filepath = mri_synthstrip(bc_mprage_file, derivatives_path,
+                                                            log_dir=report['log_dir'], report=report, threads=threads)
+            print("skull removing and brain mask creation via synthstrip is complete!!!!!")
+        else:
+            # Call CAT12 function on bias corrected image
+            cat12_output_dir = os.path.join(derivatives_path, 'mri')
+            with runner.timed_stage('cat12', report):
+                gm_file, wm_file = cat12_seg(bc_mprage_file, cat12_output_dir, threads)
+            print("************ CAT12 complete!!!!")  
+
+        stages.mark_done(state, 'skullstrip')
+
+    # Fuse the CAT12 GM and WM maps into the brain mask
+    if skull_strip_method == 'cat12' and stages.should_run(state, 'maskfusion', [gm_file, wm_file, bc_mprage_file],
+                                                           mask_cleanup, [brainmask_filepath, bc_brain_filepath]):
+        with runner.timed_stage('maskfusion', report):
+            fuse_brain_mask(gm_file, wm_file, bc_mprage_file, brainmask_filepath, bc_brain_filepath, **mask_cleanup)
+        stages.mark_done(state, 'maskfusion')
+
 
     ###############################
     ## recon-all from Freesurfer ##
@@ -278,52 +397,96 @@ def mprage_recon_all(mprage_file = None, skull_strip_method=None):
     # Define directory for Freeseurfer
     fs_dir = derivatives_path
     sub = 'freesurfer'
-        
-    # autorecon1 without skullstrip removal
-    os.system("recon-all" + \
-          " -i " + bc_mprage_file + \
-          " -hires" + \
-          " -autorecon1" + \
-          " -noskullstrip" + \
-          " -sd " + fs_dir + \
-          " -s " + sub + \
-          " -parallel")
-    print("*********** Auto recon 1 is complete")
-
-    # apply brain mask from CAT12
-    transmask = ApplyVolTransform()
-    transmask.inputs.source_file = brainmask_filepath
-    transmask.inputs.target_file = os.path.join(fs_dir, sub, 'mri', 'orig.mgz')
-    transmask.inputs.reg_header = True
-    transmask.inputs.interp = "nearest"
-    transmask.inputs.transformed_file = os.path.join(fs_dir, sub, 'mri', 'brainmask_mask.mgz')
-    transmask.inputs.args = "--no-save-reg"
-    transmask.run(cwd=cwd)
-    print("************* Applying brain mask from CAT12 is complete")
-
-    applymask = ApplyMask()
-    applymask.inputs.in_file = os.path.join(fs_dir, sub,'mri','T1.mgz')
-    applymask.inputs.mask_file = os.path.join(fs_dir, sub, 'mri', 'brainmask_mask.mgz')
-    applymask.inputs.out_file =  os.path.join(fs_dir, sub, 'mri', 'brainmask.mgz')
-    applymask.run(cwd=cwd)
-    print("************** Apply Mask is complete")
-
-
-    shutil.copy2(os.path.join(fs_dir, sub, 'mri', 'brainmask.mgz'),
-                 os.path.join(fs_dir, sub, 'mri', 'brainmask.auto.mgz'))
-
-    # continue recon-all
-    with open(os.path.join(derivatives_path,'expert.opts'), 'w') as text_file:
-        text_file.write('mris_inflate -n 100\n')
-        print("****** expert option saved as text file")
-
-    # autorecon 2 and 3
-    os.system("recon-all" + \
-              " -hires" + \
-              " -autorecon2" + " -autorecon3"\
-              " -sd " + fs_dir + \
-              " -s " + sub + \
-              " -expert " + os.path.join(derivatives_path,'expert.opts') + \
-              " -xopts-overwrite" + \
-              " -parallel")
-    print("************** Auto recon 2 and 3 are complete")
+    mri_dir = os.path.join(fs_dir, sub, 'mri')
+
+    # recon-all works on a copy of the subject dir on node-local scratch when given (see scratch.py);
+    # stage markers and final outputs stay in fs_dir
+    workspace = scratch.new_workspace(scratch_dir, fs_dir, sub, f"{subject_foldername}_{session_name}")
+    work_mri_dir = os.path.join(workspace['work_subject_dir'], 'mri')
+
+    # Thread budget of recon-all -parallel
+    threads_flags = ["-threads", str(threads)] if threads else []
+
+    # The stage sequence runs in try/finally, so a failed stage still gets its recon-all.log/.error synced
+    # back and the checkpoint thread stopped
+    try:
+        # periodic syncs of the working copy back to fs_dir while recon-all runs
+        scratch.start_checkpoints(workspace, checkpoint_interval)
+
+        # autorecon1 without skullstrip removal
+        autorecon1_flags = "-hires -autorecon1 -noskullstrip -parallel"
+        if stages.should_run(state, 'autorecon1', [bc_mprage_file], {'flags': autorecon1_flags},
+                             [os.path.join(mri_dir, 'orig.mgz'), os.path.join(mri_dir, 'T1.mgz')]):
+            # recon-all -i refuses to overwrite an existing subject, so a rerun starts from a clean subject dir
+            scratch.reset(workspace)
+            runner.run_stage('autorecon1', ["recon-all",
+                                            "-i", bc_mprage_file,
+                                            "-hires",
+                                            "-autorecon1",
+                                            "-noskullstrip",
+                                            "-sd", workspace['work_fs_dir'],
+                                            "-s", sub,
+                                            "-parallel"] + threads_flags, report['log_dir'], report)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'autorecon1')
+            print("*********** Auto recon 1 is complete")
+
+        # apply brain mask from CAT12
+        if stages.should_run(state, 'brainmask', [brainmask_filepath, os.path.join(mri_dir, 'T1.mgz')],
+                             {'mask_resampling': mask_resampling},
+                             [os.path.join(mri_dir, 'brainmask.mgz'), os.path.join(mri_dir, 'brainmask.auto.mgz')]):
+            scratch.stage_in(workspace)
+            with runner.timed_stage('brainmask', report):
+                if mask_resampling == 'freesurfer':
+                    from nipype.interfaces.freesurfer import ApplyVolTransform, ApplyMask
+                    transmask = ApplyVolTransform()
+                    transmask.inputs.source_file = brainmask_filepath
+                    transmask.inputs.target_file = os.path.join(work_mri_dir, 'orig.mgz')
+                    transmask.inputs.reg_header = True
+                    transmask.inputs.interp = "nearest"
+                    transmask.inputs.transformed_file = os.path.join(work_mri_dir, 'brainmask_mask.mgz')
+                    transmask.inputs.args = "--no-save-reg"
+                    transmask.run(cwd=cwd)
+                    print("************* Applying brain mask from CAT12 is complete")
+
+                    applymask = ApplyMask()
+                    applymask.inputs.in_file = os.path.join(work_mri_dir, 'T1.mgz')
+                    applymask.inputs.mask_file = os.path.join(work_mri_dir, 'brainmask_mask.mgz')
+                    applymask.inputs.out_file =  os.path.join(work_mri_dir, 'brainmask.mgz')
+                    applymask.run(cwd=cwd)
+                    print("************** Apply Mask is complete")
+
+
+                    shutil.copy2(os.path.join(work_mri_dir, 'brainmask.mgz'),
+                                 os.path.join(work_mri_dir, 'brainmask.auto.mgz'))
+                else:
+                    apply_brain_mask(brainmask_filepath, work_mri_dir)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'brainmask')
+
+        # continue recon-all
+        with open(os.path.join(derivatives_path,'expert.opts'), 'w') as text_file:
+            text_file.write('mris_inflate -n 100\n')
+            print("****** expert option saved as text file")
+
+        # autorecon 2 and 3
+        autorecon23_flags = "-hires -autorecon2 -autorecon3 -xopts-overwrite -parallel"
+        if stages.should_run(state, 'autorecon23', [os.path.join(mri_dir, 'brainmask.mgz'), os.path.join(derivatives_path, 'expert.opts')],
+                             {'flags': autorecon23_flags},
+                             [os.path.join(mri_dir, 'aparc+aseg.mgz'), os.path.join(fs_dir, sub, 'surf', 'lh.pial'),
+                              os.path.join(fs_dir, sub, 'surf', 'rh.pial')]):
+            scratch.stage_in(workspace)
+            runner.run_stage('autorecon23', ["recon-all",
+                                             "-hires",
+                                             "-autorecon2", "-autorecon3",
+                                             "-sd", workspace['work_fs_dir'],
+                                             "-s", sub,
+                                             "-expert", os.path.join(derivatives_path,'expert.opts'),
+                                             "-xopts-overwrite",
+                                             "-parallel"] + threads_flags, report['log_dir'], report)
+            scratch.sync_back(workspace)
+            stages.mark_done(state, 'autorecon23')
+            print("************** Auto recon 2 and 3 are complete")
+    finally:
+        # stop the checkpoint syncs, sync back and free the node-local scratch
+        scratch.finish(workspace)
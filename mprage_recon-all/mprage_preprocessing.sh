@@ -11,6 +11,7 @@
 #SBATCH --error=mprage_preprocessing_job_%A_%a.err
 #SBATCH --partition compute
 #SBATCH --exclusive=user
+##SBATCH --cpus-per-task=8 # sets SLURM_CPUS_PER_TASK, the default --threads of recon-all, synthstrip and CAT12
 #SBATCH --array=1-2 #as many lines as in config file (need to be exact line names)
 #SBATCH --time=12:00:00 
 
@@ -1,5 +1,11 @@
 #! /usr/bin/env python3
+import os
+import sys
+# The stage runner and scratch handling are shared with the other pipeline through the common folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
 import anatomy
+import runner
+import scratch
 import argparse
 
 if __name__ == "__main__":
@@ -13,10 +19,52 @@ if __name__ == "__main__":
             "--skull-strip", type=str, choices=['synthstrip', 'cat12'], required=True,
             help="choose the skull stripping method: 'synthstrip' or 'cat12'"
         )
+    parser.add_argument(
+        "--from-stage", type=str, choices=anatomy.STAGES,
+        help="rerun the pipeline from this stage on, skipping the earlier stages"
+    )
+    parser.add_argument(
+        "--until-stage", type=str, choices=anatomy.STAGES,
+        help="stop after this stage"
+    )
+    parser.add_argument(
+        "--threads", type=int,
+        help="threads for recon-all, synthstrip and the MATLAB runtime (default: SLURM_CPUS_PER_TASK)"
+    )
+    parser.add_argument(
+        "--fill-holes", action="store_true", help="fill holes in the fused CAT12 brain mask"
+    )
+    parser.add_argument(
+        "--largest-component", action="store_true", help="keep only the largest connected component of the fused CAT12 brain mask"
+    )
+    parser.add_argument(
+        "--mask-resampling", choices=["nibabel", "freesurfer"], default="nibabel",
+        help="resample and apply the brain mask in Python (default) or with mri_vol2vol/mri_mask for regression checks"
+    )
+    parser.add_argument(
+        "--scratch-dir", type=str, default=scratch.default_scratch_dir(),
+        help="node-local directory for the recon-all subject dir, synced back to the derivatives (default: $SLURM_TMPDIR or $TMPDIR)"
+    )
+    parser.add_argument(
+        "--no-scratch", action="store_true", help="run recon-all directly in the derivatives directory"
+    )
+    parser.add_argument(
+        "--checkpoint-interval", type=float, default=scratch.CHECKPOINT_INTERVAL / 60,
+        help="minutes between checkpoint syncs from the scratch directory (0 disables them)"
+    )
 
     args = parser.parse_args()
+    runner.raise_on_sigterm()
 
     anatomy.mprage_recon_all(
         mprage_file = args.mprage, 
-        skull_strip_method = args.skull_strip
+        skull_strip_method = args.skull_strip,
+        from_stage = args.from_stage,
+        until_stage = args.until_stage,
+        threads = args.threads,
+        fill_holes = args.fill_holes,
+        largest_component = args.largest_component,
+        mask_resampling = args.mask_resampling,
+        scratch_dir = None if args.no_scratch else args.scratch_dir,
+        checkpoint_interval = args.checkpoint_interval * 60
     )
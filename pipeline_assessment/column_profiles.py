@@ -0,0 +1,360 @@
+### Column Profiles ###
+## In-process replacement for the per-column fslmaths / LN2_PROFILE chain ##
+## Shared by the layer profile calculation scripts (v2.2 and v3.2) ##
+
+import os
+import sys
+import argparse
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from tqdm import tqdm
+
+# Shared NIfTI loaders and file hashes live in the common folder at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'common'))
+import nifti_io
+import hashes
+import profile_cache
+
+# Smoothing applied to every column response before building its mask (fslmaths -s 0.42553)
+SMOOTHING_SIGMA_MM = 0.42553
+
+# fslmaths truncates its gaussian kernel at 4 sigma
+KERNEL_CUTOFF = 4.0
+
+
+# CSR layout of a column label volume: flat voxel indices sorted by column and per-column offsets
+def build_column_index(columns_data):
+    labels = np.asarray(columns_data).ravel().astype(np.int64)
+    foreground = np.flatnonzero(labels > 0)
+    order = np.argsort(labels[foreground], kind='stable')
+    voxels = foreground[order]
+
+    counts = np.bincount(labels[foreground], minlength=1)
+    offsets = np.zeros(counts.size + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return {'voxels': voxels, 'offsets': offsets, 'shape': np.array(np.shape(columns_data), dtype=np.int64)}
+
+
+# Load the column index stored next to the columns file, rebuilding it if the columns file changed
+def load_column_index(columns_file, columns_data=None):
+
+    index_file = os.path.join(os.path.dirname(os.path.abspath(columns_file)),
+                              os.path.basename(columns_file).split('.')[0] + '_index.npz')
+    columns_hash = hashes.file_hash(columns_file)
+
+    if os.path.exists(index_file):
+        with np.load(index_file) as stored:
+            if str(stored['columns_hash']) == columns_hash:
+                return {key: stored[key] for key in ('voxels', 'offsets', 'shape')}
+
+    if columns_data is None:
+        columns_data = nifti_io.load_labels(columns_file)
+    column_index = build_column_index(columns_data)
+
+    # Write to a temporary file first, parallel tasks of the same subject may race for the index
+    tmp_file = f"{index_file[:-4]}.{os.getpid()}.tmp.npz"
+    try:
+        np.savez(tmp_file, columns_hash=columns_hash, **column_index)
+        os.replace(tmp_file, index_file)
+        print(f"Saved column index to: {index_file}")
+    except OSError as error:
+        print(f"Warning: could not save column index {index_file}: {error}")
+
+    return column_index
+
+
+# Flat voxel indices of a single column
+def column_voxels(column_index, column):
+    offsets = column_index['offsets']
+    if column >= offsets.size - 1:
+        return column_index['voxels'][:0]
+    return column_index['voxels'][offsets[column]:offsets[column + 1]]
+
+
+# 1D gaussian weights matching the fslmaths kernel (sigma and cutoff in voxels)
+def gaussian_kernel1d(sigma_vox, cutoff=KERNEL_CUTOFF):
+    radius = int(np.ceil(sigma_vox * cutoff))
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / sigma_vox) ** 2)
+    return kernel / kernel.sum()
+
+
+# Gaussian smoothing with sigma in mm, equivalent to "fslmaths <in> -s <sigma>" inside the FOV
+def smooth_volume(data, zooms, sigma_mm=SMOOTHING_SIGMA_MM):
+    smoothed = np.asarray(data, dtype=np.float64)
+    for axis, zoom in enumerate(zooms[:3]):
+        smoothed = ndimage.correlate1d(smoothed, gaussian_kernel1d(sigma_mm / zoom), axis=axis, mode='constant')
+    return smoothed
+
+
+# Binary simulation ROI for a single column (fslmaths -thr column -uthr column -bin)
+def create_roi(column, columns_data):
+    return columns_data == column
+
+
+# Response localized to the simulation ROI (fslmaths -mas)
+def create_roi_response(response_data, sim_roi):
+    return np.where(sim_roi, response_data, 0)
+
+
+def smooth_roi_response(roi_response, zooms, sigma_mm=SMOOTHING_SIGMA_MM):
+    return smooth_volume(roi_response, zooms, sigma_mm)
+
+
+# Positive part of the smoothed ROI response (fslmaths -thr 0 -bin)
+def create_roi_response_mask(roi_response_smoothed):
+    return roi_response_smoothed > 0
+
+
+# Column label of every voxel in the index, in index order
+def column_labels(column_index):
+    return np.repeat(np.arange(column_index['offsets'].size - 1), np.diff(column_index['offsets']))
+
+
+# Majority parcel of every column from a single column x parcel contingency table
+def column_parcel_majority(column_index, parcellation_data):
+    """
+    Background parcel voxels (0) are ignored. Returns per-column arrays indexed by column id:
+    the majority parcel (ties go to the lowest parcel id, as np.argmax over np.bincount),
+    the number of non-background voxels and the number of voxels in the majority parcel.
+    """
+    n_columns = column_index['offsets'].size - 1
+    columns = column_labels(column_index)
+    parcels = np.asarray(parcellation_data).ravel()[column_index['voxels']].astype(np.int64)
+    columns, parcels = columns[parcels > 0], parcels[parcels > 0]
+
+    # Sparse contingency table: unique (column, parcel) pairs sorted by column, then parcel
+    n_parcels = int(parcels.max()) + 1 if parcels.size else 1
+    pairs, pair_counts = np.unique(columns * n_parcels + parcels, return_counts=True)
+    pair_columns, pair_parcels = pairs // n_parcels, pairs % n_parcels
+
+    total_voxels = np.bincount(pair_columns, weights=pair_counts, minlength=n_columns).astype(np.int64)
+    chosen_voxels = np.zeros(n_columns, dtype=np.int64)
+    np.maximum.at(chosen_voxels, pair_columns, pair_counts)
+
+    # First maximal pair of each column is the one with the lowest parcel id
+    is_best = pair_counts == chosen_voxels[pair_columns]
+    best_columns, first = np.unique(pair_columns[is_best], return_index=True)
+    majority_parcel = np.zeros(n_columns, dtype=np.int64)
+    majority_parcel[best_columns] = pair_parcels[is_best][first]
+
+    return majority_parcel, total_voxels, chosen_voxels
+
+
+# Kernel radius in voxels along each axis, i.e. the 4 sigma margin the smoothing can spread a column by
+def kernel_radii(zooms, sigma_mm=SMOOTHING_SIGMA_MM, cutoff=KERNEL_CUTOFF):
+    return [int(np.ceil(sigma_mm / zoom * cutoff)) for zoom in zooms[:3]]
+
+
+# Bounding box of the ROI voxels grown by the kernel radius and clipped to the volume
+def crop_box(roi_coords, shape, radii):
+    return tuple(slice(max(int(coords.min()) - radius, 0), min(int(coords.max()) + radius + 1, size))
+                 for coords, radius, size in zip(roi_coords, radii, shape))
+
+
+# LN2_PROFILE mask of a single column as flat voxel indices of the full volume
+def column_mask(column, response_data, columns_data, column_index, zooms, radii, sigma_mm=SMOOTHING_SIGMA_MM):
+
+    roi_voxels = column_voxels(column_index, column)
+    if roi_voxels.size == 0:
+        return roi_voxels
+
+    # Smooth only the column's bounding box; the zero padded filter cannot reach beyond it
+    box = crop_box(np.unravel_index(roi_voxels, columns_data.shape), columns_data.shape, radii)
+    sim_roi = create_roi(column, columns_data[box])
+    roi_response = create_roi_response(response_data[box], sim_roi)
+    roi_response_smoothed = smooth_roi_response(roi_response, zooms, sigma_mm)
+    roi_response_mask = create_roi_response_mask(roi_response_smoothed)
+
+    # Scatter the cropped mask back to voxel indices of the full volume
+    local_coords = np.nonzero(roi_response_mask)
+    return np.ravel_multi_index(tuple(coords + bounds.start for coords, bounds in zip(local_coords, box)),
+                                columns_data.shape)
+
+
+# Copy an array into a shared memory block that worker processes can attach to without pickling it
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+# Worker state: read-only views of the shared volumes, set once per worker process
+_worker_arrays = {}
+
+
+def _attach_shared_arrays(specs, zooms, radii, sigma_mm):
+    for key, (name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=name)
+        _worker_arrays[key] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        _worker_arrays[key + '_block'] = block
+    _worker_arrays.update(zooms=zooms, radii=radii, sigma_mm=sigma_mm)
+
+
+def _column_masks_chunk(columns):
+    column_index = {'voxels': _worker_arrays['voxels'], 'offsets': _worker_arrays['offsets']}
+    return [column_mask(column, _worker_arrays['response'], _worker_arrays['columns'], column_index,
+                        _worker_arrays['zooms'], _worker_arrays['radii'], _worker_arrays['sigma_mm'])
+            for column in columns]
+
+
+# Build the masks of a column range on a process pool, returned in column order
+def _parallel_column_masks(response_data, columns_data, column_index, columns, zooms, radii, sigma_mm, workers):
+
+    blocks = []
+    specs = {}
+    try:
+        for key, array in (('response', response_data), ('columns', columns_data),
+                           ('voxels', column_index['voxels']), ('offsets', column_index['offsets'])):
+            block, specs[key] = share_array(array)
+            blocks.append(block)
+
+        # Small chunks keep the workers balanced and the progress bar moving
+        chunk_size = max(1, min(64, len(columns) // (workers * 8)))
+        chunks = [columns[i:i + chunk_size] for i in range(0, len(columns), chunk_size)]
+
+        masks = []
+        with multiprocessing.Pool(workers, initializer=_attach_shared_arrays,
+                                  initargs=(specs, zooms, radii, sigma_mm)) as pool, \
+                tqdm(total=len(columns), desc="Building column masks") as progress:
+            for chunk_masks in pool.imap(_column_masks_chunk, chunks):
+                masks.extend(chunk_masks)
+                progress.update(len(chunk_masks))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    return masks
+
+
+# Comma separated column ids given to --keep-intermediates, e.g. "1,13,42"; columns are numbered from 1
+def parse_column_list(text):
+    try:
+        columns = sorted({int(column) for column in text.split(',') if column.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma separated column numbers, got '{text}'")
+    if columns and columns[0] < 1:
+        raise argparse.ArgumentTypeError(f"column numbers start at 1, got '{text}'")
+    return columns
+
+
+# The upper bound is only known once the columns file is read; exits like argparse for columns it does not have
+def check_column_list(columns, total_columns, option='--keep-intermediates'):
+    outside = [column for column in columns if not 1 <= column <= total_columns]
+    if outside:
+        print(f"{os.path.basename(sys.argv[0])}: error: argument {option}: the columns file has columns 1 to "
+              f"{total_columns}, got {', '.join(map(str, outside))}", file=sys.stderr)
+        sys.exit(2)
+
+
+# Write the four intermediate NIfTIs of the former fslmaths chain for one column (debugging only)
+def save_column_intermediates(column, response_data, columns_data, zooms, affine, output_prefix, sigma_mm=SMOOTHING_SIGMA_MM):
+
+    sim_roi = create_roi(column, columns_data)
+    roi_response = create_roi_response(response_data, sim_roi)
+    roi_response_smoothed = smooth_roi_response(roi_response, zooms, sigma_mm)
+    roi_response_mask = create_roi_response_mask(roi_response_smoothed)
+
+    output_files = []
+    for name, data in (('sim_roi_mask', sim_roi.astype(np.int16)),
+                       ('roi_response', roi_response.astype(np.float32)),
+                       ('roi_response_smoothed', roi_response_smoothed.astype(np.float32)),
+                       ('roi_response_mask', roi_response_mask.astype(np.int16))):
+        output_file = f"{output_prefix}_{name}_{column}.nii.gz"
+        nib.save(nib.Nifti1Image(data, affine), output_file)
+        output_files.append(output_file)
+
+    return output_files
+
+
+# Collect the LN2_PROFILE mask of every column as flat voxel indices and their owning column
+def column_masks(response_data, columns_data, column_index, total_columns, zooms, sigma_mm=SMOOTHING_SIGMA_MM, workers=1,
+                 columns=None):
+
+    radii = kernel_radii(zooms, sigma_mm)
+    columns = range(1, total_columns + 1) if columns is None else list(columns)
+    if workers > 1 and len(columns) > 0:
+        masks = _parallel_column_masks(response_data, columns_data, column_index, columns, zooms, radii, sigma_mm, workers)
+    else:
+        masks = [column_mask(column, response_data, columns_data, column_index, zooms, radii, sigma_mm)
+                 for column in tqdm(columns, desc="Building column masks")]
+
+    voxels = [mask for mask in masks if mask.size > 0]
+    owners = [np.full(mask.size, column, dtype=np.int64) for column, mask in zip(columns, masks) if mask.size > 0]
+    if not voxels:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    return np.concatenate(voxels), np.concatenate(owners)
+
+
+# Mean, std and no. of voxels for every (column, layer) pair in a single bincount pass
+def profile_columns(response_data, layers_data, columns_data, voxels, owners, total_columns, expected_layers=3):
+    """
+    Returns an array of shape (total_columns, n_layers, 4) whose rows follow the LN2_PROFILE
+    output columns (layer, mean, std, no. of voxels). As with LN2_PROFILE, a column only gets
+    rows up to the last layer present in its mask; the remaining rows are NaN, which is what
+    pad_column_data produces for short LN2_PROFILE outputs.
+    """
+    n_layers = max(expected_layers, int(np.max(layers_data)))
+
+    layer_ids = layers_data.ravel()[voxels].astype(np.int64)
+    inside = layer_ids > 0
+    voxels, owners, layer_ids = voxels[inside], owners[inside], layer_ids[inside]
+
+    # LN2_PROFILE was given the column masked response, so smoothed-in neighbours count as zeros
+    values = np.where(columns_data.ravel()[voxels] == owners, response_data.ravel()[voxels], 0.0)
+
+    bins = (owners - 1) * n_layers + (layer_ids - 1)
+    size = total_columns * n_layers
+    counts = np.bincount(bins, minlength=size)
+    sums = np.bincount(bins, weights=values, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        squares = np.bincount(bins, weights=(values - means[bins]) ** 2, minlength=size)
+        stds = np.sqrt(squares / counts)
+
+    counts = counts.reshape(total_columns, n_layers)
+    profiles = np.stack([np.broadcast_to(np.arange(1, n_layers + 1), counts.shape),
+                         means.reshape(total_columns, n_layers),
+                         stds.reshape(total_columns, n_layers),
+                         counts], axis=-1).astype(np.float64)
+
+    # Blank the layers after the last populated one, as LN2_PROFILE does not write them
+    last_layer = np.where(counts > 0, np.arange(1, n_layers + 1), 0).max(axis=1)
+    profiles[np.arange(1, n_layers + 1)[np.newaxis, :] > last_layer[:, np.newaxis]] = np.nan
+
+    return profiles
+
+
+# Profiles of one response for several layerings, reusing cached columns and computing only the missing ones
+def cached_column_profiles(response_data, layerings, columns_data, column_index, total_columns, zooms,
+                           cache=None, cache_keys=None, sigma_mm=SMOOTHING_SIGMA_MM, workers=1):
+
+    all_columns = range(1, total_columns + 1)
+    cached = [profile_cache.load_profiles(cache, key, all_columns) if cache else {} for key in cache_keys or [None] * len(layerings)]
+    missing = sorted({column for hits in cached for column in all_columns if column not in hits})
+    if cache:
+        print(f"Profile cache: {total_columns - len(missing)}/{total_columns} columns found in {cache['file']}")
+
+    # Masks depend only on the response, so they are built once for all layerings
+    mask_voxels, mask_owners = column_masks(response_data, columns_data, column_index, total_columns, zooms,
+                                            sigma_mm, workers, columns=missing)
+
+    results = []
+    for layering, layers_data in enumerate(layerings):
+        profiles = profile_columns(response_data, layers_data, columns_data, mask_voxels, mask_owners, total_columns)
+        hits = cached[layering]
+        for column, column_data in hits.items():
+            profiles[column - 1] = column_data
+        if cache:
+            profile_cache.store_profiles(cache, cache_keys[layering], profiles,
+                                         [column for column in all_columns if column not in hits])
+        results.append(profiles)
+
+    return results
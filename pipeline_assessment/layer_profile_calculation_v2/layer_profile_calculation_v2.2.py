@@ -5,82 +5,60 @@
 
 import sys
 from tqdm import tqdm
-import subprocess
 import numpy as np
 import nibabel as nib
 import os
 import argparse
+import logging
 from collections import defaultdict
 
-# Create a binary mask for a specific column using fslmaths
-def create_roi(column, columns_file, response_file, subject_id, intermediate_files_path):
+# Shared column profiling engine lives in the pipeline_assessment folder, the NIfTI loaders and file hashes in common
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'common'))
+import column_profiles
+import profile_cache
+import nifti_io
+import hashes
 
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_sim_roi_mask_{column}.nii.gz")
-    command = f"fslmaths {columns_file} -thr {column} -uthr {column} -bin {output_file}"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
+logger = logging.getLogger(__name__)
 
-def create_roi_response(column, sim_roi, response_file, subject_id, intermediate_files_path):
-
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_{column}.nii.gz")
-    command = f"fslmaths {response_file} -mas {sim_roi} {output_file}"
-    subprocess.run(command, shell=True, check=True)
 
-    return output_file
-
-def smooth_roi_response(column, response_file, roi_response, subject_id, intermediate_files_path):
-    
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_smoothed_{column}.nii.gz")
-    command = f"fslmaths {roi_response} -s 0.42553 {output_file}"
-    subprocess.run(command, shell=True, check=True)
+# Profile every column of the response using the in-process equivalent of LN2_PROFILE
+def process_columns(response_file, layer_file, columns_file, total_columns, workers=1, keep_columns=(), cache=None):
 
-    return output_file
-
-def create_roi_response_mask(column, response_file, roi_response_smoothed, subject_id, intermediate_files_path):
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_mask_{column}.nii.gz")
-    command = f"fslmaths {roi_response_smoothed} -thr 0 -bin {output_file}"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
-
-# Process a single column using LN2_PROFILE function
-def process_column(column, response_file, layer_file, columns_file, subject_id):
-
-    # Make file path for saving temporary files
-    cwd = os.path.dirname(os.path.abspath(layer_file))
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    intermediate_files_path = os.path.join(cwd, 'analysis_output_v2_smooth', response_name, 'intermediate_files')
-    os.makedirs(intermediate_files_path, exist_ok=True)
+    # Load the response, layers and columns once for all columns
+    response_img = nib.load(response_file)
+    response_data = nifti_io.load_image(response_file)
+    layers_data = nifti_io.load_labels(layer_file)
+    columns_data = nifti_io.load_labels(columns_file)
+    column_index = column_profiles.load_column_index(columns_file, columns_data)
 
-    # Create binary simulation ROI column mask
-    sim_roi = create_roi(column, columns_file, response_file, subject_id, intermediate_files_path)
+    # Cache key from the content of the response, layers and columns plus the smoothing sigma
+    cache_keys = None
+    if cache:
+        cache_keys = [profile_cache.profile_key(hashes.file_hash(response_file), hashes.file_hash(layer_file),
+                                                hashes.file_hash(columns_file), column_profiles.SMOOTHING_SIGMA_MM)]
 
-    # Generate a response localized to simulation roi
-    roi_response = create_roi_response(column, sim_roi, response_file, subject_id, intermediate_files_path)
+    # Build the smoothed response mask of every column and profile them in one pass, reusing cached columns
+    profiles, = column_profiles.cached_column_profiles(response_data, [layers_data], columns_data, column_index, total_columns,
+                                                       response_img.header.get_zooms()[:3], cache, cache_keys, workers=workers)
 
-    # Smooth the ROI response
-    roi_response_smoothed = smooth_roi_response(column, response_file, roi_response, subject_id, intermediate_files_path)
+    # Debug output for selected columns only - nothing is written to disk otherwise
+    if keep_columns:
+        cwd = os.path.dirname(os.path.abspath(layer_file))
+        response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
+        subject_id = os.path.basename(os.path.dirname(os.path.dirname(response_file)))
+        intermediate_files_path = os.path.join(cwd, 'analysis_output_v2_smooth', response_name, 'intermediate_files')
+        os.makedirs(intermediate_files_path, exist_ok=True)
+        output_prefix = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}")
 
-    # Create ROI response mask
-    roi_response_mask = create_roi_response_mask(column, response_file, roi_response_smoothed, subject_id, intermediate_files_path)
+        for column in keep_columns:
+            column_profiles.save_column_intermediates(column, response_data, columns_data, response_img.header.get_zooms()[:3],
+                                                      response_img.affine, output_prefix)
+            np.savetxt(f"{output_prefix}_layer_profile_col_{column}.txt", profiles[column - 1])
+        print(f"Saved intermediate files for columns {keep_columns} to: {intermediate_files_path}")
 
-    # Run LN2_PROFILE function to get mean values for the column ROI
-    output_file = f"layer_profile_{subject_id}_{response_name}_col_{column}.txt"
-    command = f"LN2_PROFILE -input {roi_response} -layers {layer_file} -mask {roi_response_mask} -output {output_file}"
-    subprocess.run(command, shell=True, check=True)
-    
-    # Read and return the data
-    data = np.loadtxt(output_file)
-    
-    # Remove temporary files
-    os.remove(output_file)
-    
-    return data
+    return profiles
 
 
 # # Pad the column data with zeros if it has fewer than the expected number of layers
@@ -102,41 +80,36 @@ def pad_column_data(column_data, expected_layers=3):
 
 
 def map_columns_to_parcels(rim_columns_file, parcellation_file):
-    rim_columns = nib.load(rim_columns_file).get_fdata()
-    parcellation = nib.load(parcellation_file).get_fdata().astype(int)
+    column_index = column_profiles.load_column_index(rim_columns_file)
+    parcellation = nifti_io.load_labels(parcellation_file)
     
     print("\n Mapping columns to parcels... \n")
+    logger.debug("Shape of parcellation file: %s", np.shape(parcellation))   # (256, 256, 192)
+
+    # Column x parcel contingency table in one pass - majority parcel, total and chosen voxels for every column
+    majority_parcel, total_voxels, chosen_voxels = column_profiles.column_parcel_majority(column_index, parcellation)
+    column_sizes = np.diff(column_index['offsets'])
+
     column_to_parcel = {}
     parcel_info = {}
-    for column in tqdm(range(1, int(np.max(rim_columns)) + 1), desc="Mapping columns to parcels"):
-        column_mask = rim_columns == column
-        if np.any(column_mask):
-            print("Shape of parcellation file: ", np.shape(parcellation))   # (256, 256, 192)
-            print("Shape of Column mask: ", np.shape(column_mask))  # (256, 256, 192)
-            
-            parcel_values = parcellation[column_mask]
-            print("\n Parcel values - which parcel does each voxel belong to: ", (parcel_values))  # [1029 1029 1029 ...    0 1011 1011]
-            parcel_values = parcel_values[parcel_values > 0]    # remove background voxels
-            print("\n Removed voxels belonging to background: ", (parcel_values))  # [1029 1029 1029 ... 1011 1011 1011]
-            print("\n Length of Parcel values - total number of voxels in that column: ", len(parcel_values))   # 8466 voxels
-            
-            if len(parcel_values) > 0:
-                voxel_count = np.bincount(parcel_values)
-                print("\n Voxel count - frequency of each parcel: ", voxel_count)   # [   0    0  184 ...    0    0 1877]
-                most_common_parcel = np.argmax(voxel_count)
-                print("\n Most common parcel - Pick parcel with most voxels: ", most_common_parcel) # 1008
-                print("\n Number of voxels belonging to the chosen parcel: ", voxel_count[most_common_parcel], "\n")  # 5656 voxels
-                column_to_parcel[column] = most_common_parcel
-                parcel_info[column] = (len(parcel_values), voxel_count[most_common_parcel])
-            else:
-                column_to_parcel[column] = 0  
-                parcel_info[column] = (0, 0)
+    for column in np.flatnonzero(column_sizes):
+        column = int(column)
+        column_to_parcel[column] = int(majority_parcel[column])
+        parcel_info[column] = (int(total_voxels[column]), int(chosen_voxels[column]))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            parcel_values = parcellation.ravel()[column_profiles.column_voxels(column_index, column)]
+            logger.debug("Column %d", column)
+            logger.debug(" Parcel values - which parcel does each voxel belong to: %s", parcel_values)  # [1029 1029 1029 ...    0 1011 1011]
+            logger.debug(" Length of Parcel values - total number of voxels in that column: %d", total_voxels[column])   # 8466 voxels
+            logger.debug(" Most common parcel - Pick parcel with most voxels: %d", majority_parcel[column]) # 1008
+            logger.debug(" Number of voxels belonging to the chosen parcel: %d", chosen_voxels[column])  # 5656 voxels
 
     print(f"\n Mapped {len(column_to_parcel)} columns to parcels. \n")
-    print(f"{'Column':<10}{'Parcel':<10}{'Total_voxels_#':<20}{'Chosen_voxels_#':<20}")
+    logger.info(f"{'Column':<10}{'Parcel':<10}{'Total_voxels_#':<20}{'Chosen_voxels_#':<20}")
     for column, parcel in column_to_parcel.items():
         parcel_len, voxel_count = parcel_info[column]
-        print(f"{column:<10}{parcel:<10}{parcel_len:<20}{voxel_count:<20}")
+        logger.info(f"{column:<10}{parcel:<10}{parcel_len:<20}{voxel_count:<20}")
 
     return column_to_parcel
 
@@ -163,30 +136,36 @@ def get_lobe(parcel):
 
 
 ## Aggregate all columns
-def aggregate_columns(response_file, layer_file, columns_file, parcellation_file):
+def aggregate_columns(response_file, layer_file, columns_file, parcellation_file, workers=1, keep_columns=(),
+                      use_cache=True, cache_size_mb=profile_cache.DEFAULT_MAX_MB):
 
-    # Map column to parcel
-    column_to_parcel = map_columns_to_parcels(columns_file, parcellation_file)
-    
     # Extract the number of columns from the rim_columns filename
     total_columns = int(columns_file.split('columns')[-1].split('.')[0])
+    column_profiles.check_column_list(keep_columns, total_columns)
+
+    # Map column to parcel
+    column_to_parcel = map_columns_to_parcels(columns_file, parcellation_file)
 
     # Initialize expected layers and arrays for storing each column data
     expected_layers = 3
     mean_values = np.zeros((total_columns, expected_layers))
-    subject_id = os.path.basename(os.path.dirname(os.path.dirname(response_file)))
 
     # Make dictionaries for parcels data and lobe data
     parcel_data = defaultdict(list)
     lobe_data = defaultdict(list)
+
+    # Mean, std and no. of voxels for every column and layer
+    cache = profile_cache.open_cache(profile_cache.default_cache_file(columns_file), cache_size_mb) if use_cache else None
+    profiles = process_columns(response_file, layer_file, columns_file, total_columns, workers, keep_columns, cache)
+    if cache:
+        profile_cache.close_cache(cache)
     
     # Loop through each column
     for column in range(1, total_columns + 1):
-        # Process each column using LN2_PROFILE function
-        column_data = process_column(column, response_file, layer_file, columns_file, subject_id)
+        column_data = profiles[column - 1]
 
         # Check shape of column and pad it if required
-        print('Shape of Column: ', column_data.shape)
+        logger.debug('Shape of Column: %s', column_data.shape)
         column_data = pad_column_data(column_data, expected_layers)
 
         # Store mean values for this column
@@ -195,7 +174,7 @@ def aggregate_columns(response_file, layer_file, columns_file, parcellation_file
         # Store mean values of parcels
         parcel = column_to_parcel[column]
         parcel_data[parcel].append(column_data[:, 1])
-        print(f"Stored mean value for the column {column} in parcel {parcel}")
+        logger.debug(f"Stored mean value for the column {column} in parcel {parcel}")
 
     # Populate lobe_data
     for parcel, data in parcel_data.items():
@@ -235,7 +214,16 @@ if __name__ == "__main__":
     parser.add_argument("--layers", required = True, help = "Path to the rim_layer_equidist.nii file")
     parser.add_argument("--columns", required = True, help = "Path to the rim columns file - 100, 1000, 10000")
     parser.add_argument("--parcellation", required=True, help="Path to the aparc+aseg.nii.gz file from FreeSurfer")
+    parser.add_argument("--keep-intermediates", type=column_profiles.parse_column_list, default=[], metavar="COLUMN_LIST",
+                        help="Debug: write the column masks and layer profile of these comma separated columns to analysis_output_v2_smooth")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the per-subject column profile cache")
+    parser.add_argument("--cache-size-mb", type=float, default=profile_cache.DEFAULT_MAX_MB, help="Size limit of the profile cache before least recently used profiles are evicted")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes the columns are shared across (default: 1, serial)")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING"],
+                        help="DEBUG prints the per-column parcel values, WARNING hides the column to parcel table")
 
     args = parser.parse_args()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
     
-    aggregate_columns(args.response, args.layers, args.columns, args.parcellation)
\ No newline at end of file
+    aggregate_columns(args.response, args.layers, args.columns, args.parcellation, args.workers, args.keep_intermediates,
+                      not args.no_cache, args.cache_size_mb)
\ No newline at end of file
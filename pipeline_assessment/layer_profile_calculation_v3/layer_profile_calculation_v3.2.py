@@ -4,90 +4,29 @@
 ## Response contrast = Pipeline(change - flat) / Manual(change - flat) ##
 
 import sys
-from tqdm import tqdm
-import subprocess
 import numpy as np
 import nibabel as nib
 import os
 import argparse
-import uuid
 
-# Create a binary mask for a specific column using fslmaths
-def create_roi(column, columns_file, response_file, subject_id, unique_id, intermediate_files_path):
-
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_sim_roi_mask_{column}_{unique_id}.nii.gz")
-    command = f"fslmaths {columns_file} -thr {column} -uthr {column} -bin {output_file} -odt int"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
-
-def create_roi_response(column, sim_roi, response_file, subject_id, unique_id, intermediate_files_path):
-
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_{column}_{unique_id}.nii.gz")
-    command = f"fslmaths {response_file} -mas {sim_roi} {output_file}"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
-
-def smooth_roi_response(column, response_file, roi_response, subject_id, unique_id, intermediate_files_path):
-    
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_smoothed_{column}_{unique_id}.nii.gz")
-    command = f"fslmaths {roi_response} -s 0.42553 {output_file}"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
-
-def create_roi_response_mask(column, response_file, roi_response_smoothed, subject_id, unique_id, intermediate_files_path):
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    output_file = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}_roi_response_mask_{column}_{unique_id}.nii.gz")
-    command = f"fslmaths {roi_response_smoothed} -thr 0 -bin {output_file}"
-    subprocess.run(command, shell=True, check=True)
-
-    return output_file
+# Shared column profiling engine lives in the pipeline_assessment folder, the NIfTI loaders and file hashes in common
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'common'))
+import column_profiles
+import profile_cache
+import nifti_io
+import hashes
 
 
-# Process a single column using LN2_PROFILE function to give mean, std and no. of voxels 
-def process_column(column, response_file, layer_file, columns_file, subject_id):
+# Profile every column of a response with each layering (replaces the per-column fslmaths/LN2_PROFILE chain)
+def process_columns(response_data, layerings, geometry, cache_keys=None, workers=1):
 
-    # Make file path for saving temporary files
-    cwd = os.path.dirname(os.path.abspath(layer_file))
-    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
-    intermediate_files_path = os.path.join(cwd, 'analysis_output_v2_smooth', response_name, 'intermediate_files')
-    os.makedirs(intermediate_files_path, exist_ok=True)
-
-    # Create binary simulation ROI column mask
-    unique_id = str(uuid.uuid4())[:8]   # for parallely running subjects
-    sim_roi = create_roi(column, columns_file, response_file, subject_id, unique_id, intermediate_files_path)
-
-    # Generate a response localized to simulation roi
-    roi_response = create_roi_response(column, sim_roi, response_file, subject_id, unique_id, intermediate_files_path)
-
-    # Smooth the ROI response
-    roi_response_smoothed = smooth_roi_response(column, response_file, roi_response, subject_id, unique_id, intermediate_files_path)
-
-    # Create ROI response mask
-    roi_response_mask = create_roi_response_mask(column, response_file, roi_response_smoothed, subject_id, unique_id, intermediate_files_path)
-    
-    # Run LN2_PROFILE function to get mean values for the column ROI
-    output_file = f"layer_profile_{subject_id}_{response_name}_col_{column}_{unique_id}.txt"
-    command = f"LN2_PROFILE -input {roi_response} -layers {layer_file} -mask {roi_response_mask} -output {output_file}"
-    subprocess.run(command, shell=True, check=True, stdout=subprocess.DEVNULL)
-    
-    # Read and return the data
-    data = np.loadtxt(output_file)
-    
-    # Remove temporary files
-    os.remove(output_file)
+    profiles = column_profiles.cached_column_profiles(response_data, layerings, geometry['columns'], geometry['column_index'],
+                                                      geometry['total_columns'], geometry['zooms'],
+                                                      geometry['cache'], cache_keys, workers=workers)
 
-    # Check shape of column and pad it if required
-    # print('Shape of Column: ', data.shape)
-    data = pad_column_data(data)
-    # print('\nShape of Column after padding: ', data.shape)
-    
-    return data
+    # Check shape of each column and pad it if required
+    return [[pad_column_data(column_data) for column_data in layering_profiles] for layering_profiles in profiles]
 
 
 # # Pad the column data with zeros if it has fewer than the expected number of layers
@@ -126,57 +65,101 @@ def normalize_data(input_data):
     return normalized_data
 
 
-# Update the output data array with new values for the current column
-def update_nifti_with_column_values(column, new_column_data, columns_manual, selected_layer, output_image, response_values):
+# Row of the layer profile holding the values of each layer
+layer_numbers = {"deep": 0, "middle": 1, "superficial": 2}
 
-    # Load the rim columns file and create an empty array of same size
-    rim_img = nib.load(columns_manual)
-    rim_data = rim_img.get_fdata()
-    
-    # Select the layer number based on layer name
-    if selected_layer == "deep":
-        layer_number = 0
-    elif selected_layer == "middle":
-        layer_number = 1
-    elif selected_layer == "superficial":
-        layer_number = 2
-
-    # Create a mask and allocate new value to the whole column
-    column_mask = (rim_data == column)
-    output_image[column_mask] = new_column_data[layer_number, 1]    # new_column_data is 3x4. Using column 1 for mean values
-
-    # Create dictionary with all column values
-    response_values[column] = new_column_data[layer_number, 1]
-    
-    return output_image, response_values
 
+# Allocate one value to every voxel of each column with a single lookup-table gather
+def columns_to_volume(column_values, columns_data, dtype):
 
-## Transform all columns
-def transform_columns(flat_response_manual, changed_response_manual,
-                    layers_manual, layers_pipeline, 
-                    columns_manual, columns_pipeline):
+    # values[column_id]; background (0) and columns without a value stay 0
+    values = np.zeros(max(int(np.max(columns_data)), len(column_values)) + 1, dtype=dtype)
+    values[1:len(column_values) + 1] = column_values
 
-    # Load a reference NIfTI to get dimensions and header info
-    ref_img = nib.load(flat_response_manual)
-    output_image = np.zeros_like(ref_img.get_fdata())
-    
-    # Extract number of columns from columns filename and create dictionary for storing new values
-    total_columns = int(columns_manual.split('columns')[-1].split('.')[0])
+    return values[np.asarray(columns_data).astype(np.intp)]
+
+
+# Load the layers and columns shared by every response of a subject
+def load_geometry(layers_manual, layers_pipeline, columns_manual, zooms):
+
+    columns_data = nifti_io.load_labels(columns_manual)
+    geometry = {
+        'layers_manual': nifti_io.load_labels(layers_manual),
+        'layers_pipeline': nifti_io.load_labels(layers_pipeline),
+        'columns': columns_data,
+        'column_index': column_profiles.load_column_index(columns_manual, columns_data),
+        'total_columns': int(columns_manual.split('columns')[-1].split('.')[0]),
+        'zooms': zooms,
+    }
+
+    return geometry
+
+
+# Debug output for selected columns: the column masks and both layer profiles of a response
+def save_intermediates(response_file, response_img, response_data, geometry, profiles, keep_columns):
+
+    response_name = os.path.splitext(os.path.splitext(os.path.basename(response_file))[0])[0]
+    subject_id = os.path.basename(os.path.dirname(os.path.dirname(response_file)))
+    intermediate_files_path = os.path.join(geometry['output_root'], 'analysis_output_v2_smooth', response_name, 'intermediate_files')
+    os.makedirs(intermediate_files_path, exist_ok=True)
+    output_prefix = os.path.join(intermediate_files_path, f"{subject_id}_{response_name}")
+
+    for column in keep_columns:
+        column_profiles.save_column_intermediates(column, response_data, geometry['columns'], geometry['zooms'],
+                                                  response_img.affine, output_prefix)
+        for segmentation, segmentation_profiles in zip(('manual', 'pipeline'), profiles):
+            np.savetxt(f"{output_prefix}_{segmentation}_layer_profile_col_{column}.txt", segmentation_profiles[column - 1])
+
+    print(f"\nSaved intermediate files for columns {keep_columns} to: {intermediate_files_path}")
+
+
+# Manual and pipeline layer profiles of every column for one response
+def profile_response(response_file, geometry, workers=1, keep_columns=()):
+
+    response_img = nib.load(response_file)
+    response_data = nifti_io.load_image(response_file)
+
+    # Cache keys from the content of the response, layers and columns plus the smoothing sigma
+    cache_keys = None
+    if geometry['cache']:
+        response_hash = hashes.file_hash(response_file)
+        cache_keys = [profile_cache.profile_key(response_hash, geometry['hashes'][layers], geometry['hashes']['columns'],
+                                                column_profiles.SMOOTHING_SIGMA_MM)
+                      for layers in ('layers_manual', 'layers_pipeline')]
+
+    # Mean, std and no. of voxels for every column and layer
+    profiles_manual, profiles_pipeline = process_columns(response_data, [geometry['layers_manual'], geometry['layers_pipeline']],
+                                                         geometry, cache_keys, workers)
+
+    if keep_columns:
+        save_intermediates(response_file, response_img, response_data, geometry,
+                           (profiles_manual, profiles_pipeline), keep_columns)
+
+    return profiles_manual, profiles_pipeline
+
+
+## Transform all columns of one changed response
+def transform_response(changed_response_manual, flat_profiles, geometry, output_dir, workers=1, keep_columns=()):
+
+    total_columns = geometry['total_columns']
+    column_values = np.zeros(total_columns)
     response_values = {}
-    subject_id = os.path.basename(os.path.dirname(os.path.dirname(flat_response_manual)))
 
     # Selecting the layer name for allocating new values
     selected_layer = os.path.basename(changed_response_manual).split('_')[1]
+    layer_number = layer_numbers[selected_layer]
     print("\nSelected layer: ",selected_layer,"\n")
-    
+
+    profiles_flat_manual, profiles_flat_pipeline = flat_profiles
+    profiles_changed_manual, profiles_changed_pipeline = profile_response(changed_response_manual, geometry, workers, keep_columns)
+
     # Loop through each column
     for column in range(1, total_columns + 1):   
         
-        # Process each column using LN2_PROFILE function to get mean, std, and no. of voxels for the column
-        column_data_flat_manual = process_column(column, flat_response_manual, layers_manual, columns_manual, subject_id)
-        column_data_changed_manual = process_column(column, changed_response_manual, layers_manual, columns_manual, subject_id)
-        column_data_flat_pipeline = process_column(column, flat_response_manual, layers_pipeline, columns_manual, subject_id)
-        column_data_changed_pipeline = process_column(column, changed_response_manual, layers_pipeline, columns_manual, subject_id)
+        column_data_flat_manual = profiles_flat_manual[column - 1]
+        column_data_changed_manual = profiles_changed_manual[column - 1]
+        column_data_flat_pipeline = profiles_flat_pipeline[column - 1]
+        column_data_changed_pipeline = profiles_changed_pipeline[column - 1]
 
         change_in_pipeline = column_data_changed_pipeline - column_data_flat_pipeline
         change_in_manual = column_data_changed_manual - column_data_flat_manual
@@ -193,11 +176,16 @@ def transform_columns(flat_response_manual, changed_response_manual,
             print("\nDifference_manual: \n", change_in_manual)
             print("\nnew_column_data: \n", new_column_data)
 
-        # Update output data with new values for this column
-        output_image, response_values = update_nifti_with_column_values(column, new_column_data, columns_manual, 
-                                                       selected_layer, output_image, response_values)
+        # Store the new value for this column - new_column_data is 3x4. Using column 1 for mean values
+        column_values[column - 1] = new_column_data[layer_number, 1]
+        response_values[column] = new_column_data[layer_number, 1]
         print(f"\nProcessed column {column}/{total_columns}")
 
+    # Write all column values into the output volume at once, keeping the compact dtype of the response
+    response_img = nib.load(changed_response_manual)
+    output_dtype = np.result_type(response_img.get_data_dtype(), np.float32)
+    output_image = columns_to_volume(column_values, geometry['columns'], output_dtype)
+
     print("\nMax value of new output file: ", np.max(output_image), "\n")
     print("\nMin value of new output file: ", np.min(output_image), "\n")
     print("\nAll values of new output file: ")
@@ -206,27 +194,76 @@ def transform_columns(flat_response_manual, changed_response_manual,
 
     # Save the output NIfTI
     layer_name = '_'.join(os.path.basename(changed_response_manual).split('_')[1:3]).replace('.nii', '')
-    os.makedirs(os.path.join(os.path.dirname(layers_pipeline), 'differential_transformations_v2'), exist_ok=True)
-    output_file = os.path.join(os.path.dirname(layers_pipeline), "differential_transformations_v2", f'transformed_response_{layer_name}.nii.gz')
-    response_img = nib.load(changed_response_manual)
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, f'transformed_response_{layer_name}.nii.gz')
     output_img = nib.Nifti1Image(output_image, response_img.affine, response_img.header)
+    output_img.set_data_dtype(output_dtype)
     nib.save(output_img, output_file)
     print(f"\nSaved transformed data to: {output_file}")
     
     return output_file
 
 
+## Transform all columns for one or more changed responses of a subject
+def transform_columns(flat_response_manual, changed_responses_manual,
+                    layers_manual, layers_pipeline, 
+                    columns_manual, columns_pipeline, workers=1, keep_columns=(),
+                    use_cache=True, cache_size_mb=profile_cache.DEFAULT_MAX_MB):
+
+    # Load a reference NIfTI to get voxel sizes, then the geometry shared by all responses
+    ref_img = nib.load(flat_response_manual)
+    geometry = load_geometry(layers_manual, layers_pipeline, columns_manual, ref_img.header.get_zooms()[:3])
+    column_profiles.check_column_list(keep_columns, geometry['total_columns'])
+    geometry['output_root'] = os.path.dirname(layers_pipeline)
+
+    # Per-subject profile cache next to the columns file
+    geometry['cache'] = None
+    if use_cache:
+        geometry['cache'] = profile_cache.open_cache(profile_cache.default_cache_file(columns_manual), cache_size_mb)
+        geometry['hashes'] = {'layers_manual': hashes.file_hash(layers_manual),
+                              'layers_pipeline': hashes.file_hash(layers_pipeline),
+                              'columns': hashes.file_hash(columns_manual)}
+    output_dir = os.path.join(os.path.dirname(layers_pipeline), "differential_transformations_v2")
+
+    # The flat response is the baseline of every changed response - profile it only once
+    flat_profiles = profile_response(flat_response_manual, geometry, workers, keep_columns)
+
+    output_files = []
+    for changed_response_manual in changed_responses_manual:
+        if os.path.abspath(changed_response_manual) == os.path.abspath(flat_response_manual):
+            print(f"\nSkipping {changed_response_manual}: flat response is the baseline")
+            continue
+        print(f"\nProcessing response: {changed_response_manual}")
+        output_files.append(transform_response(changed_response_manual, flat_profiles, geometry, output_dir,
+                                               workers, keep_columns))
+
+    if geometry['cache']:
+        profile_cache.close_cache(geometry['cache'])
+
+    return output_files
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Transform layer profiles across columns.")
     parser.add_argument("--flat_response_manual", required = True, help = "Path to flat response file from Manual segmentation")
-    parser.add_argument("--changed_response_manual", required = True, help = "Path to changed response file from Manual segmentation")
+    responses = parser.add_mutually_exclusive_group(required = True)
+    responses.add_argument("--changed_response_manual", help = "Path to changed response file from Manual segmentation")
+    responses.add_argument("--responses", nargs = "+", help = "Paths to all changed response files of the subject, profiled in one run sharing the flat profiles")
     parser.add_argument("--layers_manual", required = True, help = "Path to the rim_layer_equidist.nii file from manual segmentation")
     parser.add_argument("--layers_pipeline", required = True, help = "Path to the rim_layer_equidist.nii file from Pipeline segmentation")
     parser.add_argument("--columns_manual", required = True, help = "Path to the rim columns file - 100, 1000, 10000 from Manual segmentation")
     parser.add_argument("--columns_pipeline", required = True, help = "Path to the rim columns file - 100, 1000, 10000 from Pipeline segmentation")
+    parser.add_argument("--keep-intermediates", type = column_profiles.parse_column_list, default = [], metavar = "COLUMN_LIST",
+                        help = "Debug: write the column masks and layer profiles of these comma separated columns to analysis_output_v2_smooth")
+    parser.add_argument("--no-cache", action = "store_true", help = "Do not read or write the per-subject column profile cache")
+    parser.add_argument("--cache-size-mb", type = float, default = profile_cache.DEFAULT_MAX_MB, help = "Size limit of the profile cache before least recently used profiles are evicted")
+    parser.add_argument("--workers", type = int, default = 1, help = "Number of processes the columns are shared across (default: 1, serial)")
 
     args = parser.parse_args()
     
-    transform_columns(args.flat_response_manual, args.changed_response_manual,
+    changed_responses_manual = args.responses if args.responses else [args.changed_response_manual]
+
+    transform_columns(args.flat_response_manual, changed_responses_manual,
                     args.layers_manual, args.layers_pipeline,
-                    args.columns_manual, args.columns_pipeline)
+                    args.columns_manual, args.columns_pipeline, args.workers, args.keep_intermediates,
+                    not args.no_cache, args.cache_size_mb)
@@ -0,0 +1,49 @@
+#!/bin/bash -l
+
+##############################
+#       Job blueprint        #
+##############################
+
+#### define some basic SLURM properties for this job - one task per subject, all responses at once
+#SBATCH --job-name=layer_profile_calculation_v3.2_batch
+#SBATCH --output=layer_profile_calculation_v3.2_batch_%A_%a.out
+#SBATCH --error=layer_profile_calculation_v3.2_batch_%A_%a.err
+#SBATCH --partition=compute
+#SBATCH --array=1-6 #as many subjects as in config file
+#SBATCH --time=1:00:00  
+#SBATCH --mem=5GB  
+
+# Define environment
+container=/ptmp/kaggarwal/containers/gfae.sif 
+MINICONDA_PATH=/opt/conda/bin/activate 
+
+# Define data directory
+studyDataDir=/home/kaggarwal/ptmp/layersim_experiment
+
+# Extract the subject from config file and collect all of its responses
+config_file="config.txt"
+subject_id=$(awk '{print $1}' "$config_file" | awk '!seen[$0]++' | sed -n "$SLURM_ARRAY_TASK_ID"p)
+responses=$(awk -v subject="$subject_id" -v dir="${studyDataDir}/layersim_experiment_hand_segmentation/sub-${subject_id}/smoothed_responses" \
+    '$1 == subject {printf "%s/%s.nii.gz ", dir, $2}' "$config_file")
+
+echo "Processing subject: ${subject_id}"
+echo "Processing responses: ${responses}"
+
+## Run the Python script inside the container
+srun apptainer exec ${container} bash -c \
+"source ${MINICONDA_PATH} && python ${studyDataDir}/layer_profile_calculation_v3/layer_profile_calculation_v3.2.py \
+    --flat_response_manual ${studyDataDir}/layersim_experiment_hand_segmentation/sub-${subject_id}/smoothed_responses/response_flat.nii.gz \
+    --responses ${responses} \
+    --layers_manual ${studyDataDir}/layersim_experiment_hand_segmentation/sub-${subject_id}/rim_layers_equidist.nii \
+    --layers_pipeline ${studyDataDir}/layersim_experiment_mri_vol2vol/sub-${subject_id}/rim_layers_equidist.nii \
+    --columns_manual ${studyDataDir}/layersim_experiment_hand_segmentation/sub-${subject_id}/rim_columns100.nii \
+    --columns_pipeline ${studyDataDir}/layersim_experiment_hand_segmentation/sub-${subject_id}/rim_columns100.nii"
+# Note: Columns are coming from hand segmentation. No columns will come from pipeline
+
+
+# Cleanup output logs into a separate directory
+mkdir -p ${SLURM_SUBMIT_DIR}/SLURM_OUTPUT
+mv ${SLURM_SUBMIT_DIR}/*.err ${SLURM_SUBMIT_DIR}/SLURM_OUTPUT/
+mv ${SLURM_SUBMIT_DIR}/*.out ${SLURM_SUBMIT_DIR}/SLURM_OUTPUT/
+
+exit 0
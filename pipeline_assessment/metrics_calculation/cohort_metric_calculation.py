@@ -0,0 +1,166 @@
+## Cohort-level metric calculation: all subjects from config.txt in a local process pool, one tidy table as output
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import traceback
+import contextlib
+from multiprocessing import Pool
+
+import metric_calculation
+
+# Content hashes of the inputs, shared with the layer profile scripts through the common folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'common'))
+from hashes import file_hash
+
+# Same layout as parallel_metric_calculation.sh
+MANUAL_TEMPLATE = "{study_dir}/layersim_experiment_hand_segmentation/sub-{subject}/sub-{subject}_ses-1_manual_seg.nii"
+PIPELINE_TEMPLATE = "{study_dir}/layersim_experiment_mri_vol2vol/synthstrip_results/sub-{subject}/rim.nii.gz"
+FIELDS = ['subject', 'label', 'metric', 'value', 'runtime']
+
+
+def read_subjects(config_file):
+    with open(config_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# Everything a subject's result depends on; unchanged signature means the previous rows are reused
+def input_signature(manual_path, pipeline_path, labels, hausdorff_backend):
+    return {'manual': file_hash(manual_path), 'pipeline': file_hash(pipeline_path),
+            'labels': labels, 'hausdorff_backend': hausdorff_backend}
+
+
+def subject_metrics(task):
+    subject, manual_path, pipeline_path, labels, hausdorff_backend, log_file = task
+
+    # Per-subject log instead of the SLURM .out files; a failing subject returns its error instead of
+    # raising, so the other subjects of the cohort still finish
+    start = time.time()
+    with open(log_file, 'w') as log, contextlib.redirect_stdout(log):
+        try:
+            if labels:
+                results = metric_calculation.multi_label_metrics(
+                    manual_path, pipeline_path, metric_calculation.parse_label_spec(labels), hausdorff_backend)
+            else:
+                dice, hausdorff, hausdorff_95, mean_surface_distance = metric_calculation.metric_calculation(
+                    manual_path, pipeline_path, hausdorff_backend)
+                results = {'GM': {'dice': dice, 'hausdorff': hausdorff, 'hausdorff_95': hausdorff_95,
+                                  'mean_surface_distance': mean_surface_distance}}
+        except Exception as e:
+            traceback.print_exc(file=log)
+            return subject, None, time.time() - start, f"{type(e).__name__}: {e}"
+    runtime = time.time() - start
+
+    rows = [{'subject': subject, 'label': label, 'metric': metric, 'value': float(value), 'runtime': round(runtime, 3)}
+            for label, metrics in results.items() for metric, value in metrics.items()]
+    return subject, rows, runtime, None
+
+
+def read_table(output_file):
+    if not os.path.exists(output_file):
+        return []
+    if output_file.endswith('.parquet'):
+        import pandas as pd
+        return pd.read_parquet(output_file).astype({'subject': str}).to_dict('records')
+    with open(output_file, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def write_table(output_file, rows):
+    if output_file.endswith('.parquet'):
+        # Parquet needs pandas with pyarrow, which is not part of the container environment
+        import pandas as pd
+        pd.DataFrame(rows, columns=FIELDS).to_parquet(output_file, index=False)
+        return
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def cohort_metric_calculation(config_file, study_dir, output_file, labels=None, hausdorff_backend="kdtree",
+                              workers=1, force=False, manual_template=MANUAL_TEMPLATE, pipeline_template=PIPELINE_TEMPLATE):
+
+    if workers < 1:
+        raise ValueError(f"workers must be at least 1, got {workers}")
+
+    subjects = read_subjects(config_file)
+    log_dir = os.path.join(os.path.dirname(os.path.abspath(output_file)), 'metric_logs')
+    os.makedirs(log_dir, exist_ok=True)
+
+    # Input signatures of the previous run are kept next to the table
+    state_file = output_file + '.inputs.json'
+    previous_state = {}
+    if os.path.exists(state_file) and os.path.exists(output_file):
+        with open(state_file) as f:
+            previous_state = json.load(f)
+    previous_rows = read_table(output_file)
+
+    state, tasks, kept_rows = {}, [], {}
+    for subject in subjects:
+        manual_path = manual_template.format(study_dir=study_dir, subject=subject)
+        pipeline_path = pipeline_template.format(study_dir=study_dir, subject=subject)
+        if not (os.path.exists(manual_path) and os.path.exists(pipeline_path)):
+            print(f"Skipping subject {subject}: missing {manual_path if not os.path.exists(manual_path) else pipeline_path}")
+            continue
+
+        state[subject] = input_signature(manual_path, pipeline_path, labels, hausdorff_backend)
+        if not force and previous_state.get(subject) == state[subject]:
+            print(f"Subject {subject}: inputs unchanged, keeping previous results")
+            kept_rows[subject] = [row for row in previous_rows if str(row['subject']) == subject]
+            continue
+
+        log_file = os.path.join(log_dir, f"sub-{subject}.log")
+        tasks.append((subject, manual_path, pipeline_path, labels, hausdorff_backend, log_file))
+
+    new_rows, failures = {}, {}
+    if tasks:
+        with Pool(min(workers, len(tasks))) as pool:
+            for subject, rows, runtime, error in pool.imap_unordered(subject_metrics, tasks):
+                if error is not None:
+                    # No rows and no signature: the subject is recomputed on the next run
+                    failures[subject] = error
+                    del state[subject]
+                    print(f"Subject {subject}: FAILED after {runtime:.1f} s ({error}), see {os.path.join(log_dir, f'sub-{subject}.log')}")
+                    continue
+                new_rows[subject] = rows
+                print(f"Subject {subject}: done in {runtime:.1f} s")
+
+    # Rows in config.txt order
+    all_rows = [row for subject in subjects for row in new_rows.get(subject, kept_rows.get(subject, []))]
+    write_table(output_file, all_rows)
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=2)
+    print(f"\nSaved {len(all_rows)} rows for {len(new_rows)} computed and {len(kept_rows)} unchanged subjects to: {output_file}")
+    if failures:
+        print(f"{len(failures)} subject(s) failed:")
+        for subject, error in failures.items():
+            print(f"  {subject}: {error}")
+
+    return all_rows, failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Dice and Hausdorff metrics for all subjects of config.txt in a local process pool")
+    parser.add_argument("--config", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.txt"),
+                        help = "Subject ids, one per line")
+    parser.add_argument("--study_dir", required = True, help = "Path to layersim_experiment/")
+    parser.add_argument("--output", required = True, help = "Output table (.csv, or .parquet with pandas and pyarrow)")
+    parser.add_argument("--labels", nargs = "+", metavar = "NAME:MANUAL:PIPELINE",
+                        help = "Label pairs for the multi-label mode, e.g. GM:3,42:3 WM:2,41:2")
+    parser.add_argument("--hausdorff-backend", choices = ["kdtree", "edt"], default = "kdtree")
+    parser.add_argument("--workers", type = int, default = 1, help = "Subjects processed in parallel")
+    parser.add_argument("--force", action = "store_true", help = "Recompute subjects whose inputs are unchanged")
+    parser.add_argument("--manual-template", default = MANUAL_TEMPLATE, help = "Manual segmentation path with {study_dir} and {subject}")
+    parser.add_argument("--pipeline-template", default = PIPELINE_TEMPLATE, help = "Pipeline rim path with {study_dir} and {subject}")
+
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    _, failures = cohort_metric_calculation(args.config, args.study_dir, args.output, args.labels, args.hausdorff_backend,
+                                            args.workers, args.force, args.manual_template, args.pipeline_template)
+    sys.exit(1 if failures else 0)
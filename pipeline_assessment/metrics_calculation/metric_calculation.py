@@ -1,15 +1,23 @@
 ## Dice coefficient calculation between rim_columns100.nii in manual and pipeline output
 
+import os
+import sys
 import argparse
 import time
 import nibabel as nib
 import numpy as np
 from scipy.spatial.distance import directed_hausdorff
+from scipy.spatial import cKDTree
+from scipy.ndimage import binary_erosion, distance_transform_edt
+
+# Shared NIfTI loaders live in the common folder at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'common'))
+import nifti_io
 
 
 def calculate_dice_coefficient(manual_foreground, pipeline_foreground):
     # Calculate the intersection and union of the foreground masks
-    intersection = np.sum(manual_foreground * pipeline_foreground)
+    intersection = np.count_nonzero(manual_foreground & pipeline_foreground)
     print("\n intersection: ", intersection)
     union = np.sum(manual_foreground) + np.sum(pipeline_foreground)
     print("\n union: ", union)
@@ -37,48 +45,258 @@ def calculate_hausdorff_distance(manual_coords, pipeline_coords, voxel_sizes):
     return hausdorff_distance
 
 
-def metric_calculation(manual_path, pipeline_path):
+# Voxels on the surface of a mask (mask XOR its erosion)
+def surface_voxels(mask):
+    return mask ^ binary_erosion(mask)
+
+
+# Distances (mm) from source voxels to the target, measured against the target surface only
+def distances_to_surface(source, target, voxel_sizes, backend="kdtree"):
+    """
+    The voxel of the target closest to any voxel outside of it is always a target surface voxel,
+    so distances to the target surface equal point-set distances for source voxels outside the
+    target, which are the only ones that can set the Hausdorff distance.
+    Returns the distances of those outside voxels and of the source surface voxels.
+    """
+    target_surface = surface_voxels(target)
+    source_outside = source & ~target
+    source_surface = surface_voxels(source)
+
+    if backend == "edt":
+        # Anisotropic Euclidean distance transform to the target surface, sampled at the voxel sizes
+        distance_map = distance_transform_edt(~target_surface, sampling=voxel_sizes)
+        return distance_map[source_outside], distance_map[source_surface]
+
+    # KD-tree over the target surface, queried once for outside and surface voxels together
+    tree = cKDTree(np.argwhere(target_surface) * voxel_sizes)
+    query = source_outside | source_surface
+    distances, _ = tree.query(np.argwhere(query) * voxel_sizes, workers=-1)
+    return distances[source_outside[query]], distances[source_surface[query]]
+
+
+def calculate_surface_distances(manual_foreground, pipeline_foreground, voxel_sizes, backend="kdtree"):
+
+    print(f"\n Calculating surface distances in mm ({backend}) ....")
+    outside_1, surface_1 = distances_to_surface(manual_foreground, pipeline_foreground, voxel_sizes, backend)
+    outside_2, surface_2 = distances_to_surface(pipeline_foreground, manual_foreground, voxel_sizes, backend)
+
+    # Hausdorff distance of the foreground voxels - same value as calculate_hausdorff_distance
+    hausdorff_distance_1 = np.max(outside_1, initial=0)
+    hausdorff_distance_2 = np.max(outside_2, initial=0)
+    print("\n hausdorff distance 1: ", hausdorff_distance_1)
+    print("\n hausdorff distance 2: ", hausdorff_distance_2)
+    hausdorff_distance = max(hausdorff_distance_1, hausdorff_distance_2)
+
+    # Surface to surface metrics: larger of the two directed 95th percentiles, mean over both surfaces
+    hausdorff_distance_95 = max(np.percentile(surface_1, 95), np.percentile(surface_2, 95))
+    mean_surface_distance = np.concatenate((surface_1, surface_2)).mean()
+
+    return hausdorff_distance, hausdorff_distance_95, mean_surface_distance
+
+
+def load_segmentations(manual_path, pipeline_path):
     # Load the manual and pipeline NIfTI files
     manual_nii = nib.load(manual_path)
     pipeline_nii = nib.load(pipeline_path)
 
-    # Extract data from NIfTI files
-    manual_data = manual_nii.get_fdata()
-    pipeline_data = pipeline_nii.get_fdata()
+    # Extract label data from NIfTI files in their native integer dtype
+    manual_data = nifti_io.load_labels(manual_nii)
+    pipeline_data = nifti_io.load_labels(pipeline_nii)
 
     # Extract voxel resolution from Affine matrix
     print("\n Affine matrix: ", manual_nii.affine)
     voxel_sizes = np.sqrt((manual_nii.affine[:3, :3] ** 2).sum(axis=0))
     print("\n Voxel sizes (in mm):", voxel_sizes)
 
+    return manual_data, pipeline_data, voxel_sizes
+
+
+def metric_calculation(manual_path, pipeline_path, hausdorff_backend="kdtree"):
+    manual_data, pipeline_data, voxel_sizes = load_segmentations(manual_path, pipeline_path)
+
     # Selcting only GM (3) - WM(2), CSF(1), Background(0) for pipeline output
     # For manual segmentation, choosing 3 for left and 42 for right GM
     manual_foreground = (manual_data == 3) | (manual_data == 42)
     pipeline_foreground = pipeline_data > 2
 
-    # Extract the coordinates of the foreground voxels
-    manual_coords = np.argwhere(manual_foreground)
-    pipeline_coords = np.argwhere(pipeline_foreground)
-    print("\n shape of manual_coords: ", np.shape(manual_coords))
-    print("shape of pipeline_coords: ", np.shape(pipeline_coords))
-    print("First few manual_coords:", manual_coords[:5])
-    print("First few pipeline_coords:", pipeline_coords[:5])
-
     # Compute the Dice coefficient
     dice_coefficient = calculate_dice_coefficient(manual_foreground, pipeline_foreground)
 
     # Compute the Hausdorff Coefficient
-    hausdorff_distance = calculate_hausdorff_distance(manual_coords, pipeline_coords, voxel_sizes)
+    if hausdorff_backend == "scipy":
+        # Reference: directed_hausdorff over the coordinates of all foreground voxels
+        manual_coords = np.argwhere(manual_foreground)
+        pipeline_coords = np.argwhere(pipeline_foreground)
+        print("\n shape of manual_coords: ", np.shape(manual_coords))
+        print("shape of pipeline_coords: ", np.shape(pipeline_coords))
+        hausdorff_distance = calculate_hausdorff_distance(manual_coords, pipeline_coords, voxel_sizes)
+        hausdorff_distance_95, mean_surface_distance = np.nan, np.nan
+    else:
+        hausdorff_distance, hausdorff_distance_95, mean_surface_distance = calculate_surface_distances(
+            manual_foreground, pipeline_foreground, voxel_sizes, hausdorff_backend)
     print(f"\n Hausdorff distance: {hausdorff_distance:.2f}")
+    print(f"\n 95th percentile Hausdorff distance: {hausdorff_distance_95:.2f}")
+    print(f"\n Mean surface distance: {mean_surface_distance:.2f}")
+
+    return dice_coefficient, hausdorff_distance, hausdorff_distance_95, mean_surface_distance
+
+
+## Multi-label mode ##
+
+# Label pair spec "NAME:MANUAL_LABELS:PIPELINE_LABELS" with comma separated labels, e.g. "GM:3,42:3" or "GM_left:3:3"
+def parse_label_spec(specs):
+    label_pairs = {}
+    for spec in specs:
+        try:
+            name, manual_labels, pipeline_labels = spec.split(":")
+            label_pairs[name] = ([int(label) for label in manual_labels.split(",")],
+                                 [int(label) for label in pipeline_labels.split(",")])
+        except ValueError:
+            raise ValueError(f"Invalid label spec '{spec}', expected NAME:MANUAL_LABELS:PIPELINE_LABELS")
+    return label_pairs
+
+
+# Voxel counts of every (manual label, pipeline label) combination from one joint bincount
+def confusion_counts(manual_data, pipeline_data):
+    if manual_data.min() < 0 or pipeline_data.min() < 0:
+        raise ValueError("Label maps must not contain negative labels")
+    n_manual = int(manual_data.max()) + 1
+    n_pipeline = int(pipeline_data.max()) + 1
+
+    joint = manual_data.astype(np.int64).ravel()
+    joint *= n_pipeline
+    joint += pipeline_data.ravel()
+
+    return np.bincount(joint, minlength=n_manual * n_pipeline).reshape(n_manual, n_pipeline)
 
-    return dice_coefficient, hausdorff_distance
+
+# Overlap and volume metrics of one label pair from the confusion counts
+def overlap_metrics(counts, manual_labels, pipeline_labels, voxel_volume):
+    # Labels absent from a volume have no bin and count as empty
+    manual_labels = [label for label in manual_labels if label < counts.shape[0]]
+    pipeline_labels = [label for label in pipeline_labels if label < counts.shape[1]]
+
+    intersection = counts[np.ix_(manual_labels, pipeline_labels)].sum()
+    manual_volume = counts[manual_labels].sum()
+    pipeline_volume = counts[:, pipeline_labels].sum()
+
+    return {
+        'dice': 2 * intersection / (manual_volume + pipeline_volume),
+        'jaccard': intersection / (manual_volume + pipeline_volume - intersection),
+        'volume_manual_mm3': manual_volume * voxel_volume,
+        'volume_pipeline_mm3': pipeline_volume * voxel_volume,
+        'volume_difference_mm3': (pipeline_volume - manual_volume) * voxel_volume,
+        'relative_volume_difference': (pipeline_volume - manual_volume) / manual_volume if manual_volume else np.nan,
+    }
+
+
+def multi_label_metrics(manual_path, pipeline_path, label_pairs, hausdorff_backend="kdtree"):
+    manual_data, pipeline_data, voxel_sizes = load_segmentations(manual_path, pipeline_path)
+    voxel_volume = np.prod(voxel_sizes)
+
+    counts = confusion_counts(manual_data, pipeline_data)
+
+    results = {}
+    for name, (manual_labels, pipeline_labels) in label_pairs.items():
+        metrics = overlap_metrics(counts, manual_labels, pipeline_labels, voxel_volume)
+
+        # Surface distances need the masks themselves; skipped when either side is empty
+        if metrics['volume_manual_mm3'] > 0 and metrics['volume_pipeline_mm3'] > 0:
+            print(f"\n Label {name}:")
+            hausdorff_distance, hausdorff_distance_95, mean_surface_distance = calculate_surface_distances(
+                np.isin(manual_data, manual_labels), np.isin(pipeline_data, pipeline_labels),
+                voxel_sizes, hausdorff_backend)
+        else:
+            hausdorff_distance, hausdorff_distance_95, mean_surface_distance = np.nan, np.nan, np.nan
+        metrics.update({'hausdorff': hausdorff_distance, 'hausdorff_95': hausdorff_distance_95,
+                        'mean_surface_distance': mean_surface_distance})
+        results[name] = metrics
+
+    print("\n" + "label".ljust(15) + "".join(metric.rjust(14) for metric in ['dice', 'jaccard', 'vol_diff_mm3', 'hausdorff', 'hd95', 'msd']))
+    for name, metrics in results.items():
+        print(name.ljust(15) + "".join(f"{metrics[metric]:14.3f}" for metric in
+              ['dice', 'jaccard', 'volume_difference_mm3', 'hausdorff', 'hausdorff_95', 'mean_surface_distance']))
+
+    return results
+
+
+## Out-of-core mode ##
+# Both volumes are read slab by slab along the last axis (contiguous on disk for NIfTI), so peak memory
+# is a few slabs regardless of the volume size (.nii.gz inputs are decompressed once, front to back, as they are read).
+# Only overlap and volume metrics can be accumulated this way.
+
+def iter_slabs(manual_path, pipeline_path, slab_size):
+    # Slabs in file order: .nii files are memory mapped, .nii.gz files are decompressed once as a stream
+    with nifti_io.open_for_slabs(manual_path) as manual_nii, nifti_io.open_for_slabs(pipeline_path) as pipeline_nii:
+        if manual_nii.shape != pipeline_nii.shape:
+            raise ValueError(f"Shape mismatch: {manual_nii.shape} vs {pipeline_nii.shape}")
+        for start in range(0, manual_nii.shape[-1], slab_size):
+            slab = (Ellipsis, slice(start, start + slab_size))
+            yield nifti_io.load_labels(manual_nii, slicer=slab), nifti_io.load_labels(pipeline_nii, slicer=slab)
+
+
+def chunked_dice(manual_path, pipeline_path, slab_size=16):
+    # Same foreground definitions as metric_calculation
+    intersection, manual_volume, pipeline_volume = 0, 0, 0
+    for manual_slab, pipeline_slab in iter_slabs(manual_path, pipeline_path, slab_size):
+        manual_foreground = (manual_slab == 3) | (manual_slab == 42)
+        pipeline_foreground = pipeline_slab > 2
+        manual_volume += np.count_nonzero(manual_foreground)
+        pipeline_volume += np.count_nonzero(pipeline_foreground)
+        manual_foreground &= pipeline_foreground
+        intersection += np.count_nonzero(manual_foreground)
+
+    print("\n intersection: ", intersection)
+    print("\n union: ", manual_volume + pipeline_volume)
+    dice_coefficient = (2 * intersection) / (manual_volume + pipeline_volume)
+    print(f"\n Dice coefficient: {dice_coefficient:.2f}")
+
+    return dice_coefficient
+
+
+def chunked_multi_label_metrics(manual_path, pipeline_path, label_pairs, slab_size=16):
+    voxel_volume = np.prod(np.sqrt((nib.load(manual_path).affine[:3, :3] ** 2).sum(axis=0)))
+
+    # Confusion counts of each slab, added into a table that grows with the largest labels seen
+    counts = np.zeros((1, 1), dtype=np.int64)
+    for manual_slab, pipeline_slab in iter_slabs(manual_path, pipeline_path, slab_size):
+        slab_counts = confusion_counts(manual_slab, pipeline_slab)
+        shape = np.maximum(counts.shape, slab_counts.shape)
+        counts = np.pad(counts, [(0, shape[0] - counts.shape[0]), (0, shape[1] - counts.shape[1])])
+        counts[:slab_counts.shape[0], :slab_counts.shape[1]] += slab_counts
+
+    results = {name: overlap_metrics(counts, manual_labels, pipeline_labels, voxel_volume)
+               for name, (manual_labels, pipeline_labels) in label_pairs.items()}
+
+    print("\n" + "label".ljust(15) + "".join(metric.rjust(14) for metric in ['dice', 'jaccard', 'vol_diff_mm3']))
+    for name, metrics in results.items():
+        print(name.ljust(15) + "".join(f"{metrics[metric]:14.3f}" for metric in ['dice', 'jaccard', 'volume_difference_mm3']))
+
+    return results
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description = "Dice coefficient calculation between manual segmentation and rim.nii file")
     parser.add_argument("--manual", required = True, help = "Path to layersim_experiment_hand_segmentation/sub-id/manual_seg.nii/")
     parser.add_argument("--pipeline", required = True, help = "Path to layersim_experiment_mri_vol2vol/sub-id/rim.nii.gz/")
+    parser.add_argument("--hausdorff-backend", choices = ["kdtree", "edt", "scipy"], default = "kdtree",
+                        help = "Surface KD-tree (default), anisotropic distance transform, or scipy directed_hausdorff over all voxels")
+    parser.add_argument("--labels", nargs = "+", metavar = "NAME:MANUAL:PIPELINE",
+                        help = "Label pairs for the multi-label mode, e.g. GM:3,42:3 WM:2,41:2 GM_left:3:3")
+
+    parser.add_argument("--chunked", action = "store_true",
+                        help = "Stream both volumes slab by slab with bounded memory; overlap and volume metrics only")
+    parser.add_argument("--slab-size", type = int, default = 16, help = "Slices per slab in --chunked mode")
 
     args = parser.parse_args()
 
-    metric_calculation(args.manual, args.pipeline)
\ No newline at end of file
+    if args.chunked and args.labels:
+        chunked_multi_label_metrics(args.manual, args.pipeline, parse_label_spec(args.labels), args.slab_size)
+    elif args.chunked:
+        chunked_dice(args.manual, args.pipeline, args.slab_size)
+    elif args.labels:
+        if args.hausdorff_backend == "scipy":
+            parser.error("--labels uses the surface distance engine, choose --hausdorff-backend kdtree or edt")
+        multi_label_metrics(args.manual, args.pipeline, parse_label_spec(args.labels), args.hausdorff_backend)
+    else:
+        metric_calculation(args.manual, args.pipeline, args.hausdorff_backend)
\ No newline at end of file
@@ -0,0 +1,88 @@
+### Profile Cache ###
+## Content-addressed store of per-column layer profiles, one sqlite file per subject ##
+## Keys are built from the content hashes of the response, layers and columns volumes and the smoothing sigma ##
+
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+# Stored next to the subject's columns file, so every script and response of the subject shares it
+CACHE_FILENAME = 'column_profile_cache.sqlite'
+DEFAULT_MAX_MB = 1024
+
+
+def profile_key(response_hash, layers_hash, columns_hash, sigma_mm):
+    return hashlib.sha256(f"{response_hash}:{layers_hash}:{columns_hash}:{sigma_mm!r}".encode()).hexdigest()
+
+
+def default_cache_file(columns_file):
+    return os.path.join(os.path.dirname(os.path.abspath(columns_file)), CACHE_FILENAME)
+
+
+def open_cache(cache_file, max_mb=DEFAULT_MAX_MB):
+
+    # Parallel SLURM tasks of one subject share the file, so wait for locks instead of failing
+    connection = sqlite3.connect(cache_file, timeout=120)
+    with connection:
+        connection.execute("CREATE TABLE IF NOT EXISTS profiles ("
+                           "profile_key TEXT, column_id INTEGER, n_layers INTEGER, data BLOB, "
+                           "size INTEGER, last_used REAL, PRIMARY KEY (profile_key, column_id))")
+        connection.execute("CREATE INDEX IF NOT EXISTS profiles_last_used ON profiles (last_used)")
+
+    return {'connection': connection, 'max_bytes': int(max_mb * 1024 * 1024), 'file': cache_file}
+
+
+def close_cache(cache):
+    cache['connection'].close()
+
+
+# Cached profiles of the requested columns as {column: (n_layers, 4) array}; marks them as recently used
+def load_profiles(cache, key, columns):
+
+    connection = cache['connection']
+    rows = connection.execute("SELECT column_id, n_layers, data FROM profiles WHERE profile_key = ?", (key,)).fetchall()
+    wanted = set(columns)
+    hits = {column: np.frombuffer(data, dtype=np.float64).reshape(n_layers, 4)
+            for column, n_layers, data in rows if column in wanted}
+
+    if hits:
+        with connection:
+            connection.execute("UPDATE profiles SET last_used = ? WHERE profile_key = ?", (time.time(), key))
+
+    return hits
+
+
+def store_profiles(cache, key, profiles, columns):
+
+    now = time.time()
+    rows = []
+    for column in columns:
+        data = np.ascontiguousarray(profiles[column - 1], dtype=np.float64)
+        rows.append((key, int(column), data.shape[0], data.tobytes(), data.nbytes, now))
+
+    with cache['connection'] as connection:
+        connection.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?, ?)", rows)
+    evict(cache)
+
+
+# Drop the least recently used profiles until the store fits in its size budget
+def evict(cache):
+
+    connection = cache['connection']
+    total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM profiles").fetchone()[0]
+    excess = total_bytes - cache['max_bytes']
+    if excess <= 0:
+        return
+
+    evicted = []
+    for key, column, size in connection.execute("SELECT profile_key, column_id, size FROM profiles ORDER BY last_used"):
+        evicted.append((key, column))
+        excess -= size
+        if excess <= 0:
+            break
+
+    with connection:
+        connection.executemany("DELETE FROM profiles WHERE profile_key = ? AND column_id = ?", evicted)
+    print(f"Evicted {len(evicted)} column profiles from {cache['file']}")